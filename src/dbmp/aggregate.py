@@ -0,0 +1,209 @@
+"""
+Reductions for --metrics-op.
+
+Every op reduces a value column (see metrics.Series) to one number, using
+numpy when it's installed and plain python over the array otherwise.  Ops
+run per app_instance, per group of app_instances (--metrics-group-by) or,
+with the "total-" prefix, across every app_instance.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import array
+import math
+import re
+
+import six
+
+from dbmp.volume import ai_sis
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# array typecode for int64 columns, python 2 has no 'q' but its 'l' is
+# 64 bits on the platforms dbmp runs on
+INT64 = str('q') if six.PY3 else str('l')
+# Metrics the API reports as running totals rather than per-second values
+COUNTERS = ('reads', 'writes', 'bytes_read', 'bytes_written')
+GROUP_BY = ('prefix', 'storage_node', 'placement_policy')
+
+
+def _column(values):
+    """
+    Returns a value column as a numpy array sharing its memory when numpy
+    is available, otherwise the column itself
+    """
+    if np is None:
+        return values
+    return np.frombuffer(
+        values, dtype=np.int64 if values.typecode == INT64 else np.float64)
+
+
+def _scalar(v):
+    # numpy scalars aren't JSON serializable
+    return v.item() if hasattr(v, 'item') else v
+
+
+def _average(v):
+    if np is not None:
+        return int(np.sum(_column(v)) / len(v))
+    return int(sum(v) / len(v))
+
+
+def _max(v):
+    return _scalar(np.max(_column(v))) if np is not None else max(v)
+
+
+def _min(v):
+    return _scalar(np.min(_column(v))) if np is not None else min(v)
+
+
+def _stddev(v):
+    if np is not None:
+        return _scalar(np.std(_column(v)))
+    mean = sum(v) / len(v)
+    return math.sqrt(sum((x - mean) ** 2 for x in v) / len(v))
+
+
+def _percentile(q):
+    # Linear interpolation between the closest ranks, same as numpy's
+    # default so results don't depend on whether numpy is installed
+    def _func(v):
+        if np is not None:
+            return _scalar(np.percentile(_column(v), q))
+        ordered = sorted(v)
+        rank = (len(ordered) - 1) * q / 100
+        low = int(math.floor(rank))
+        high = min(low + 1, len(ordered) - 1)
+        return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+    return _func
+
+
+REDUCERS = {
+    'average': _average,
+    'max': _max,
+    'min': _min,
+    'stddev': _stddev,
+    'p50': _percentile(50),
+    'p90': _percentile(90),
+    'p99': _percentile(99),
+    'p99.9': _percentile(99.9),
+}
+
+OPS = tuple(sorted(REDUCERS)) + tuple(
+    'total-{}'.format(op) for op in sorted(REDUCERS))
+
+
+def concat(columns):
+    """ Joins value columns into one, as float64 if any of them are """
+    typecode = INT64
+    if any(c.typecode == 'd' for c in columns):
+        typecode = str('d')
+    joined = array.array(typecode)
+    for c in columns:
+        joined.extend(c if c.typecode == typecode else
+                      array.array(typecode, c))
+    return joined
+
+
+def rates(series):
+    """
+    Replaces a counter Series' values with the per-second rate between each
+    pair of consecutive points, using the array's millisecond timestamps.
+    Pairs where the counter went backwards (eg: it was reset) or time
+    didn't move forward are dropped
+    """
+    ticks, times, values = series.ticks, series.times, series.values
+    if np is not None:
+        dt = np.diff(np.frombuffer(times, dtype=np.int64)) / 1000
+        dv = np.diff(_column(values)).astype(np.float64)
+        keep = (dt > 0) & (dv >= 0)
+        idx = np.nonzero(keep)[0] + 1
+        series.ticks = array.array(str('i'), (ticks[i] for i in idx))
+        series.times = array.array(INT64, (times[i] for i in idx))
+        series.values = array.array(
+            str('d'), (dv[keep] / dt[keep]).tolist())
+        return series
+    kept = [(ticks[i], times[i],
+             (values[i] - values[i - 1]) * 1000 / (times[i] - times[i - 1]))
+            for i in range(1, len(values))
+            if times[i] > times[i - 1] and values[i] >= values[i - 1]]
+    series.ticks = array.array(str('i'), (k[0] for k in kept))
+    series.times = array.array(INT64, (k[1] for k in kept))
+    series.values = array.array(str('d'), (k[2] for k in kept))
+    return series
+
+
+def group_keys(ais, by, snodes=None):
+    """
+    Returns a dict of app_instance name to the name of the group it belongs
+    to.  `by` is one of GROUP_BY, snodes maps storage node uuids to names
+    """
+    keys = {}
+    for ai in ais:
+        name = ai['name']
+        if by == 'prefix':
+            # dbmp names volumes <prefix>-<index>
+            keys[name] = re.sub(r'-\d+$', '', name)
+            continue
+        found = set()
+        for si in ai_sis(ai):
+            if by == 'storage_node':
+                for sn in si.get('active_storage_nodes', []):
+                    uuid = sn['path'].split('/')[-1]
+                    found.add((snodes or {}).get(uuid, uuid))
+                continue
+            for vol in si['volumes']:
+                if 'placement_policy' in vol:
+                    found.add(vol['placement_policy']['path'].split('/')[-1])
+                else:
+                    found.add(vol.get('placement_mode'))
+        keys[name] = ",".join(sorted(str(f) for f in found))
+    return keys
+
+
+def _reduce(func, values):
+    # A counter with a single point has no rates
+    return func(values) if len(values) else None
+
+
+def apply_op(results, op, rate=False, groups=None):
+    """
+    Reduces the Series in `results` in place.  `rate` turns COUNTERS into
+    per-second rates first.  `groups` maps app_instance names to group names
+    to reduce each group's points together instead of each app_instance's
+    """
+    if rate:
+        for v1 in results.values():
+            for m in v1:
+                if m in COUNTERS:
+                    v1[m] = rates(v1[m])
+    if not op:
+        return
+    total = op.startswith('total-')
+    func = REDUCERS[op[len('total-'):] if total else op]
+    if total:
+        groups = {name: 'total_{}'.format(op[len('total-'):])
+                  for name in results}
+    if groups is None:
+        for v1 in results.values():
+            for m, series in v1.items():
+                v1[m] = _reduce(func, series.values)
+        return
+    columns = {}
+    for name, v1 in results.items():
+        group = columns.setdefault(groups.get(name, name), {})
+        for m, series in v1.items():
+            group.setdefault(m, []).append(series.values)
+    newr = {}
+    for group, v1 in columns.items():
+        for m, cols in v1.items():
+            value = _reduce(func, concat(cols))
+            if total:
+                newr['{}_{}'.format(group, m)] = value
+            else:
+                newr.setdefault(group, {})[m] = value
+    results.clear()
+    results.update(newr)
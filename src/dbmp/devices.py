@@ -0,0 +1,304 @@
+"""
+In-process block device resolution.
+
+Resolves /dev/disk/by-path links, reads /proc/mounts and reads/writes sysfs
+attributes without forking a shell for each lookup.  Every path is resolved
+relative to ROOT (or the `root` argument) so the functions can be pointed at
+a fake sysfs/procfs/dev tree.
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import ctypes
+import ctypes.util
+import errno
+import io
+import os
+import re
+import select
+import threading
+
+from dbmp.utils import exe, dprint, monotonic
+
+ROOT = '/'
+INITIATOR_FILE = '/etc/iscsi/initiatorname.iscsi'
+MOUNT_ESCAPE = re.compile(r'\\([0-7]{3})')
+BY_PATH = '/dev/disk/by-path'
+# Directories whose entries change when iSCSI devices come and go.  sysfs
+# doesn't emit inotify events, so /sys/block changes are picked up by the
+# periodic re-check instead
+WATCH_DIRS = ('/dev', '/dev/disk', BY_PATH)
+
+# inotify(7) constants
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+IN_NONBLOCK = os.O_NONBLOCK
+
+
+def host_path(path, root=None):
+    """ Returns `path` relocated under root """
+    root = root or ROOT
+    return os.path.join(root, path.lstrip('/'))
+
+
+def resolve_device(path, root=None):
+    """
+    Follows a device link (eg: /dev/disk/by-path/...) and returns the kernel
+    name of the device it points at (eg: sdc or dm-2), or None if the link
+    doesn't exist yet
+    """
+    hpath = host_path(path, root)
+    if not os.path.lexists(hpath):
+        return None
+    real = os.path.realpath(hpath)
+    if not os.path.exists(real):
+        return None
+    return os.path.basename(real)
+
+
+def target_links(iqn, root=None):
+    """ Returns the /dev/disk/by-path entries belonging to target `iqn` """
+    try:
+        entries = os.listdir(host_path(BY_PATH, root))
+    except OSError:
+        return []
+    return [e for e in entries if "-iscsi-{}-lun-".format(iqn) in e]
+
+
+def _unescape(field):
+    # /proc/mounts escapes whitespace in paths as octal, eg: \040
+    return MOUNT_ESCAPE.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+def read_mounts(root=None):
+    """
+    Parses /proc/mounts and returns a dict of kernel device name to mount
+    point.  Sources such as /dev/mapper/<name> are resolved to their dm-*
+    device so they match names returned by resolve_device
+    """
+    mounts = {}
+    with io.open(host_path('/proc/mounts', root)) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 2 or not parts[0].startswith('/dev/'):
+                continue
+            device = resolve_device(_unescape(parts[0]), root)
+            if device:
+                mounts.setdefault(device, _unescape(parts[1]))
+    return mounts
+
+
+def sysfs_path(device, attr, root=None):
+    return host_path(os.path.join('/sys/block', device, attr), root)
+
+
+def read_sysfs(device, attr, root=None):
+    with io.open(sysfs_path(device, attr, root)) as f:
+        return f.read().strip()
+
+
+def write_sysfs(device, attr, value, root=None):
+    """
+    Writes a sysfs attribute directly, falling back to sudo when dbmp isn't
+    running as root
+    """
+    path = sysfs_path(device, attr, root)
+    try:
+        with io.open(path, 'w') as f:
+            f.write("{}".format(value))
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EACCES, errno.EPERM):
+            raise
+        dprint("Writing {} with sudo".format(path))
+        exe("echo '{}' | sudo tee {}".format(value, path))
+
+
+class DmIndex(object):
+
+    """
+    Reverse index of block device to the dm-* device it's a slave of.
+
+    A miss first checks the device's own /sys/block/<dev>/holders entry,
+    which also covers paths added to an existing multipath map, then reads
+    the slaves of only those dm-* devices that appeared since the last scan.
+    Hits are checked with a single stat so reused sd names are never matched
+    to a stale map.
+    """
+
+    def __init__(self, root=None):
+        self.root = root
+        self.scans = 0
+        self._slaves = {}
+        self._known = set()
+        self._lock = threading.Lock()
+
+    def _block(self, *parts):
+        return host_path(os.path.join('/sys/block', *parts), self.root)
+
+    def _scan(self, dms):
+        for dm in dms:
+            self.scans += 1
+            try:
+                slaves = os.listdir(self._block(dm, 'slaves'))
+            except OSError:
+                continue
+            for slave in slaves:
+                self._slaves[slave] = dm
+
+    def _valid(self, sdevice):
+        dm = self._slaves.get(sdevice)
+        if dm and os.path.exists(self._block(dm, 'slaves', sdevice)):
+            return dm
+        self._slaves.pop(sdevice, None)
+        return None
+
+    def lookup(self, sdevice):
+        """ Returns the dm-* device `sdevice` belongs to, or None """
+        with self._lock:
+            dm = self._valid(sdevice)
+            if dm:
+                return dm
+            try:
+                holders = os.listdir(self._block(sdevice, 'holders'))
+            except OSError:
+                holders = []
+            for holder in holders:
+                if holder.startswith('dm-'):
+                    self._slaves[sdevice] = holder
+                    return holder
+            try:
+                dms = {d for d in os.listdir(self._block())
+                       if d.startswith('dm-')}
+            except OSError:
+                return None
+            self._scan(dms - self._known)
+            self._known = dms
+            return self._valid(sdevice)
+
+
+DM_INDEX = DmIndex()
+
+
+def read_initiator_name(root=None):
+    """ Returns the InitiatorName from the open-iscsi initiator file """
+    path = host_path(INITIATOR_FILE, root)
+    try:
+        with io.open(path) as f:
+            out = f.read()
+    except (IOError, OSError) as e:
+        if e.errno not in (errno.EACCES, errno.EPERM):
+            raise EnvironmentError(
+                "Could not read the iSCSI Initiator File {}: {}".format(
+                    path, e))
+        out = exe('sudo cat {}'.format(path))
+    for line in out.splitlines():
+        if line.startswith('InitiatorName='):
+            return line.split("=", 1)[-1].strip()
+
+
+class DeviceWatcher(object):
+
+    """
+    Wakes threads waiting on device nodes as soon as something under
+    WATCH_DIRS changes.
+
+    Uses inotify through libc when available.  Without it (or for state that
+    has no events, like sysfs) waiters re-check their condition every
+    `poll_interval` seconds.
+    """
+
+    def __init__(self, root=None, poll_interval=0.25, recheck_interval=1.0):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.recheck_interval = recheck_interval
+        self.events = 0
+        self._cond = threading.Condition()
+        self._fd = None
+        self._watched = set()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _add_watches(self, libc):
+        for d in WATCH_DIRS:
+            path = host_path(d, self.root)
+            if path in self._watched or not os.path.isdir(path):
+                continue
+            if libc.inotify_add_watch(
+                    self._fd, path.encode('utf-8'), IN_MASK) >= 0:
+                self._watched.add(path)
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._thread = False
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                   use_errno=True)
+                fd = libc.inotify_init1(IN_NONBLOCK)
+            except (OSError, AttributeError) as e:
+                dprint("inotify unavailable, polling for devices:", e)
+                return
+            if fd < 0:
+                dprint("inotify_init1 failed, polling for devices")
+                return
+            self._fd = fd
+            self._add_watches(libc)
+            self._thread = threading.Thread(target=self._run, args=(libc,))
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self, libc):
+        while True:
+            readable, _, _ = select.select([self._fd], [], [])
+            if not readable:
+                continue
+            try:
+                os.read(self._fd, 65536)
+            except OSError:
+                pass
+            # by-path only exists once the first disk is attached
+            self._add_watches(libc)
+            with self._cond:
+                self.events += 1
+                self._cond.notify_all()
+
+    @property
+    def active(self):
+        return bool(self._thread)
+
+    def wait_change(self, timeout):
+        """ Blocks until the next device event or `timeout` seconds """
+        self._start()
+        with self._cond:
+            self._cond.wait(timeout)
+
+    def wait_for(self, predicate, timeout):
+        """
+        Returns the first truthy result of `predicate`, evaluating it again
+        whenever a device event arrives.  Returns its last falsy result if
+        `timeout` seconds pass first
+        """
+        self._start()
+        interval = self.recheck_interval if self.active else \
+            self.poll_interval
+        deadline = monotonic() + timeout
+        while True:
+            with self._cond:
+                seen = self.events
+            result = predicate()
+            if result:
+                return result
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return result
+            with self._cond:
+                if self.events == seen:
+                    self._cond.wait(min(remaining, interval))
+
+
+WATCHER = DeviceWatcher()
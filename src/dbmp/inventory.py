@@ -0,0 +1,137 @@
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import json
+import os
+import time
+
+from dfs_sdk import scaffold
+
+from dbmp.utils import SqliteStore, dprint
+
+INVENTORY = os.path.expanduser(os.path.join("~", ".dbmp", "inventory.db"))
+# Seconds a cached listing may be used for before it's fetched again.
+# 0 disables reading from the cache
+MAX_AGE = 0
+
+
+def configure(max_age):
+    """ Sets how many seconds cached listings may be used for """
+    global MAX_AGE
+    MAX_AGE = max_age or 0
+
+
+class CachedEntity(dict):
+
+    """
+    app_instance data read from the inventory.  Supports the same attribute
+    and item access to data keys as an SDK entity, but has no endpoints so
+    it can only be used by read-only code paths
+    """
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError(attr)
+
+
+class Inventory(SqliteStore):
+
+    """
+    Local cache of app_instances (with their embedded storage_instances and
+    volumes) keyed by cluster and tenant.
+
+    Each listing is cached under the filter it was made with.  Stale listings
+    are refetched individually so a refresh only covers the app_instances the
+    caller asked for.  dbmp's own creates and deletes update the cached
+    app_instance and invalidate every listing for the tenant.
+    """
+
+    def _setup(self, conn):
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS ais ("
+                         "tenant TEXT, "
+                         "name TEXT, "
+                         "data TEXT, "
+                         "PRIMARY KEY (tenant, name))")
+            conn.execute("CREATE TABLE IF NOT EXISTS listings ("
+                         "tenant TEXT, "
+                         "filter TEXT, "
+                         "names TEXT, "
+                         "fetched REAL, "
+                         "PRIMARY KEY (tenant, filter))")
+
+    @staticmethod
+    def _tenant():
+        config = scaffold.get_config()
+        return "{}{}".format(config.get('mgmt_ip'),
+                             config.get('tenant') or '/root')
+
+    def listing(self, key, fetch):
+        """
+        Returns the app_instances cached under `key` if they were fetched
+        within MAX_AGE seconds, otherwise calls `fetch` and caches its result
+        """
+        if not MAX_AGE:
+            return fetch()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tenant = self._tenant()
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT names, fetched FROM listings "
+            "WHERE tenant = ? AND filter = ?", (tenant, key)).fetchone()
+        if row and time.time() - row[1] <= MAX_AGE:
+            names = json.loads(row[0])
+            found = self._get(conn, tenant, names)
+            if len(found) == len(names):
+                dprint("Using cached listing for:", key)
+                return found
+        ais = fetch()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO ais VALUES (?, ?, ?)",
+                [(tenant, ai['name'], json.dumps(dict(ai))) for ai in ais])
+            conn.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+                (tenant, key, json.dumps([ai['name'] for ai in ais]),
+                 time.time()))
+        return ais
+
+    @staticmethod
+    def _get(conn, tenant, names):
+        found = []
+        for name in names:
+            row = conn.execute(
+                "SELECT data FROM ais WHERE tenant = ? AND name = ?",
+                (tenant, name)).fetchone()
+            if row:
+                found.append(CachedEntity(json.loads(row[0])))
+        return found
+
+    def update(self, ai):
+        """ Records an app_instance dbmp created or modified """
+        if not os.path.exists(self.path):
+            return
+        tenant = self._tenant()
+        conn = self._conn()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO ais VALUES (?, ?, ?)",
+                         (tenant, ai['name'], json.dumps(dict(ai))))
+            conn.execute("DELETE FROM listings WHERE tenant = ?", (tenant,))
+
+    def remove(self, name):
+        """ Forgets an app_instance dbmp deleted """
+        if not os.path.exists(self.path):
+            return
+        tenant = self._tenant()
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM ais WHERE tenant = ? AND name = ?",
+                         (tenant, name))
+            conn.execute("DELETE FROM listings WHERE tenant = ?", (tenant,))
+
+
+INV = Inventory(INVENTORY)
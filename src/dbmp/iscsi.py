@@ -0,0 +1,202 @@
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import io
+import json
+import os
+import re
+import threading
+
+from dbmp.devices import host_path, read_sysfs
+from dbmp.utils import exe, dprint
+
+# Session profile names to open-iscsi node record settings
+SESSION_KEYS = {
+    'cmds_max': 'node.session.cmds_max',
+    'queue_depth': 'node.session.queue_depth',
+    'MaxRecvDataSegmentLength': 'node.conn[0].iscsi.MaxRecvDataSegmentLength',
+    'FirstBurstLength': 'node.session.iscsi.FirstBurstLength',
+    'replacement_timeout': 'node.session.timeo.replacement_timeout',
+}
+
+SESSION_PROFILES = {
+    # open-iscsi defaults to cmds_max=128 and queue_depth=32, which throttles
+    # fio at high iodepths long before the target does
+    'high-qd': {
+        'cmds_max': 1024,
+        'queue_depth': 128,
+        'MaxRecvDataSegmentLength': 262144,
+        'FirstBurstLength': 262144,
+        'replacement_timeout': 15,
+    },
+}
+
+
+class DiscoveryCache(object):
+
+    """
+    SendTargets discovery results for each portal during this run.
+
+    Discovery for a portal runs the first time a target behind it is needed
+    and again only if a requested target wasn't in the last result, so logging
+    into hundreds of targets behind the same access VIPs discovers each VIP
+    once.  Discovery also creates the node records logins use.
+    """
+
+    def __init__(self):
+        self.targets = {}
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._portal_locks = {}
+
+    def _portal_lock(self, portal):
+        with self._lock:
+            return self._portal_locks.setdefault(portal, threading.Lock())
+
+    def ensure(self, portal, iqn, refresh=False):
+        """
+        Makes sure `iqn` has been discovered through `portal`, running
+        discovery only if it hasn't been seen yet or `refresh` is set
+        """
+        with self._portal_lock(portal):
+            if not refresh and iqn in self.targets.get(portal, ()):
+                return
+            out = exe("sudo iscsiadm -m discovery -t st -p {}:3260".format(
+                portal))
+            with self._lock:
+                self.calls += 1
+            # Lines look like: 172.16.0.10:3260,1 iqn.2013-05.com.daterainc:...
+            self.targets[portal] = {line.split()[-1]
+                                    for line in out.splitlines()
+                                    if line.strip()}
+            if iqn not in self.targets[portal]:
+                dprint("Target {} not found by discovery on portal "
+                       "{}".format(iqn, portal))
+
+    def forget(self, portal):
+        with self._portal_lock(portal):
+            self.targets.pop(portal, None)
+
+
+DISCOVERY = DiscoveryCache()
+
+
+def load_session_profile(name):
+    """
+    Returns the built-in session profile `name` or the profile read from
+    JSON file `name`.  Raises a ValueError if it can't be used
+    """
+    if name in SESSION_PROFILES:
+        return SESSION_PROFILES[name]
+    if not os.path.isfile(name):
+        raise ValueError(
+            "Unknown iSCSI session profile: {}.  Choices: {} or a JSON "
+            "file".format(name, ", ".join(sorted(SESSION_PROFILES))))
+    with io.open(name) as f:
+        profile = json.load(f)
+    unknown = set(profile) - set(SESSION_KEYS)
+    if unknown:
+        raise ValueError(
+            "Unknown settings in iSCSI session profile {}: {}".format(
+                name, ", ".join(sorted(unknown))))
+    return profile
+
+
+def _read(path, root=None):
+    try:
+        with io.open(host_path(path, root)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def session_values(device, root=None):
+    """
+    Returns the session name and the values in effect for the iSCSI session
+    `device` (eg: sdc) belongs to.  Sizes are the negotiated ones, so they
+    can be lower than what the node record asked for
+    """
+    # /sys/block/sdc/device resolves to something like
+    # /sys/devices/platform/host3/session2/target3:0:0/3:0:0:1
+    real = os.path.realpath(host_path(
+        os.path.join('/sys/block', device, 'device'), root))
+    host = next((p for p in real.split(os.sep)
+                 if re.match(r'host\d+$', p)), None)
+    session = next((p for p in real.split(os.sep)
+                    if re.match(r'session\d+$', p)), None)
+    if not session:
+        return None, {}
+    conn = 'connection{}:0'.format(session[len('session'):])
+    try:
+        queue_depth = read_sysfs(device, 'device/queue_depth', root)
+    except (IOError, OSError):
+        queue_depth = None
+    return session, {
+        'cmds_max': _read(
+            '/sys/class/scsi_host/{}/can_queue'.format(host), root),
+        'queue_depth': queue_depth,
+        'MaxRecvDataSegmentLength': _read(
+            '/sys/class/iscsi_connection/{}/max_recv_dlength'.format(conn),
+            root),
+        'FirstBurstLength': _read(
+            '/sys/class/iscsi_session/{}/first_burst_len'.format(session),
+            root),
+        'replacement_timeout': _read(
+            '/sys/class/iscsi_session/{}/recovery_tmo'.format(session), root),
+    }
+
+
+class SessionProfile(object):
+
+    """
+    Writes iSCSI session settings into node records before login and
+    records the values each resulting session ended up with
+    """
+
+    def __init__(self, profile=None, root=None):
+        self.profile = profile or {}
+        self.name = None
+        self.root = root
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def apply(self, iqn, portal):
+        """ Updates the node record for `iqn` on `portal` """
+        for key, value in sorted(self.profile.items()):
+            exe("sudo iscsiadm -m node -T {iqn} -p {ip}:3260 -o update "
+                "-n '{name}' -v {value}".format(
+                    iqn=iqn, ip=portal, name=SESSION_KEYS[key], value=value))
+
+    def record(self, iqn, portal, device):
+        """ Records the settings of the session `device` was attached by """
+        if not self.profile:
+            return
+        session, values = session_values(device, self.root)
+        if not session:
+            dprint("Could not find the iSCSI session for:", device)
+            return
+        with self._lock:
+            self.sessions[session] = (iqn, portal, values)
+
+    def report(self):
+        if not self.name or not self.sessions:
+            return
+        for session, (iqn, portal, values) in sorted(self.sessions.items()):
+            settings = []
+            for key in sorted(self.profile):
+                setting = "{}={}".format(key, values.get(key))
+                if str(values.get(key)) != str(self.profile[key]):
+                    setting += " (wanted {})".format(self.profile[key])
+                settings.append(setting)
+            print("Session {} {} {}: {}".format(
+                session, portal, iqn, ", ".join(settings)))
+
+
+SESSIONS = SessionProfile()
+
+
+def configure(name):
+    """ Sets the session profile applied before each login """
+    if name:
+        SESSIONS.profile = load_session_profile(name)
+        SESSIONS.name = name
@@ -0,0 +1,79 @@
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import io
+import json
+import os
+
+from dbmp.utils import SqliteStore, dprint
+
+KEYSTORE = ".dbmp-obj-keys.db"
+# Flat JSON file used before the sqlite keystore, migrated on first use
+LEGACY_KEYFILE = ".dbmp-obj-keys"
+
+
+class KeyStore(SqliteStore):
+
+    """
+    Object store access/secret keys indexed by volume name.
+
+    Inserts, lookups and deletes only touch the rows involved, and sqlite
+    serializes writers, including ones in other dbmp processes.
+    """
+
+    def __init__(self, path=KEYSTORE, legacy=LEGACY_KEYFILE):
+        super(KeyStore, self).__init__(path)
+        self.legacy = legacy
+
+    def _setup(self, conn):
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS obj_keys ("
+                         "name TEXT PRIMARY KEY, "
+                         "access_key TEXT, "
+                         "secret_key TEXT)")
+        self._migrate(conn)
+
+    def _migrate(self, conn):
+        if not os.path.exists(self.legacy):
+            return
+        data = {}
+        with io.open(self.legacy, 'r') as f:
+            try:
+                data = json.load(f)
+            except ValueError:
+                pass
+        with conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO obj_keys VALUES (?, ?, ?)",
+                [(n, ak, sk) for n, (ak, sk) in data.items()])
+        try:
+            os.rename(self.legacy, self.legacy + '.migrated')
+        except OSError:
+            # Another dbmp process already migrated it
+            pass
+        dprint("Migrated {} object keys from {} to {}".format(
+            len(data), self.legacy, self.path))
+
+    def exists(self):
+        return os.path.exists(self.path) or os.path.exists(self.legacy)
+
+    def put(self, name, ak, sk):
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO obj_keys VALUES (?, ?, ?)",
+                (name, ak, sk))
+
+    def get(self, name):
+        row = self._conn().execute(
+            "SELECT access_key, secret_key FROM obj_keys WHERE name = ?",
+            (name,)).fetchone()
+        if not row:
+            return None, None
+        return list(row)
+
+    def delete(self, names):
+        conn = self._conn()
+        with conn:
+            conn.executemany("DELETE FROM obj_keys WHERE name = ?",
+                             [(n,) for n in names])
@@ -50,18 +50,22 @@ import textwrap
 from dfs_sdk import scaffold
 
 from dbmp.events import clear_alerts, list_alerts, list_events
-from dbmp.metrics import get_metrics, write_metrics
+from dbmp.metrics import get_metrics, read_metrics, write_metrics
 from dbmp.mount import mount_volumes, clean_mounts
-from dbmp.mount import list_mounts
+from dbmp.mount import list_mounts, pipeline_volumes, STAGES, CLEAN_STAGES
 from dbmp.fio import gen_fio
 from dbmp.vdbench import gen_vdb
-from dbmp.utils import exe
+from dbmp.utils import exe, AUTO
 from dbmp.volume import create_volumes, clean_volumes, list_volumes
 from dbmp.volume import list_templates, get_keys, del_keys
 from dbmp.placement_policy import create_media_policy, create_placement_policy
 from dbmp.placement_policy import list_placement_policies, list_media_policies
 from dbmp.placement_policy import delete_placement_policy, delete_media_policy
 from dbmp.csi_yaml import udc_envs_from_csi_yaml
+from dbmp import aggregate
+from dbmp import inventory
+from dbmp import iscsi
+from dbmp import tuning
 from dbmp import show
 
 SUCCESS = 0
@@ -86,6 +90,43 @@ def hf(txt):
     return textwrap.fill(txt)
 
 
+def workers_type(value):
+    if value == AUTO:
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "--workers must be an integer or '{}'".format(AUTO))
+
+
+def stage_workers_type(value):
+    # Example --stage-workers "create=10,login=4"
+    stages = STAGES + CLEAN_STAGES
+    limits = {}
+    for part in value.split(','):
+        stage, sep, limit = part.partition('=')
+        stage = stage.strip()
+        if not sep or stage not in stages:
+            raise argparse.ArgumentTypeError(
+                "Unrecognized stage limit: {}.  Expected <stage>=<workers> "
+                "with stages: {}".format(part, ", ".join(stages)))
+        try:
+            limits[stage] = workers_type(limit.strip())
+        except argparse.ArgumentTypeError:
+            raise argparse.ArgumentTypeError(
+                "Workers for stage {} must be an integer or '{}'".format(
+                    stage, AUTO))
+    return limits
+
+
+def stage_limits(stage_workers, workers):
+    """ Fills in --workers for every stage --stage-workers didn't set """
+    limits = {stage: workers for stage in STAGES + CLEAN_STAGES}
+    limits.update(stage_workers or {})
+    return limits
+
+
 def run_health(api):
     config = scaffold.get_config()
     try:
@@ -120,6 +161,13 @@ def main(args):
     api = scaffold.get_api()
     print('Using Config:')
     scaffold.print_config()
+    inventory.configure(args.cache_max_age)
+    try:
+        tuning.configure(args.tune_profile)
+        iscsi.configure(args.iscsi_profile)
+    except ValueError as e:
+        print(e)
+        return FAILURE
 
     if args.health:
         if not run_health(api):
@@ -148,9 +196,11 @@ def main(args):
             print("###### VOLUMES {}######".format(
                 "DETAIL " if detail else ''))
             for vol in args.volume:
-                list_volumes('local', api, vol, detail=detail)
+                list_volumes('local', api, vol, detail=detail,
+                             page_size=args.list_page_size)
             if not args.volume:
-                list_volumes('local', api, 'prefix=all', detail)
+                list_volumes('local', api, 'prefix=all', detail,
+                             page_size=args.list_page_size)
         elif 'templates' in arg:
             print("###### TEMPLATES {}######".format(
                 "DETAIL " if detail else ''))
@@ -160,10 +210,10 @@ def main(args):
                 "DETAIL " if detail else ''))
             for vol in args.volume:
                 list_mounts('local', api, vol, detail,
-                            not args.no_multipath)
+                            not args.no_multipath, args.list_page_size)
             else:
                 list_mounts('local', api, 'prefix=all', detail,
-                            not args.no_multipath)
+                            not args.no_multipath, args.list_page_size)
         elif 'alerts' in arg:
             print("###### ALERTS ######")
             list_alerts(api)
@@ -190,16 +240,20 @@ def main(args):
     if any((args.unmount, args.logout, args.clean)):
         for vol in args.volume:
             del_keys(vol)
-            clean_mounts(api, vol, args.directory, args.workers)
+            clean_mounts(api, vol, args.directory, args.workers,
+                         stage_limits(args.stage_workers, args.workers))
             if args.unmount:
                 return SUCCESS
     if args.clean:
+        failed = {}
         for vol in args.volume:
-            clean_volumes(api, vol, args.workers)
+            failed.update(clean_volumes(api, vol, args.workers))
         for pp in args.placement_policy:
             delete_placement_policy(api, pp)
         for mp in args.media_policy:
             delete_media_policy(api, mp)
+        if failed:
+            return FAILURE
         return SUCCESS
     if args.logout:
         return SUCCESS
@@ -211,10 +265,24 @@ def main(args):
     for pp in args.placement_policy:
         create_placement_policy(api, pp)
 
+    # Create, login and mount volumes as a single pipeline
+    login_only = not args.mount and args.login
+    if args.pipeline and (args.mount or args.login):
+        stage_workers = stage_limits(args.stage_workers, args.workers)
+        dev_or_folders = []
+        for vol in args.volume:
+            dev_or_folders.extend(pipeline_volumes(
+                "local", api, vol, not args.no_multipath, args.fstype,
+                args.fsargs, args.directory, stage_workers, login_only,
+                args.force_initiator_creation, args.initiator_path,
+                args.reconcile))
+
     # Create volumes
     vols = None
-    for vol in args.volume:
-        vols = create_volumes("local", api, vol, args.workers)
+    if not args.pipeline or not (args.mount or args.login):
+        for vol in args.volume:
+            vols = create_volumes("local", api, vol, args.workers,
+                                  args.reconcile)
 
     if args.get_keys:
         for vol in args.volume:
@@ -222,7 +290,6 @@ def main(args):
                 print(n, ":", ' '.join(map(str, keys)))
 
     # Login/mount volumes
-    login_only = not args.mount and args.login
     if (args.mount or args.login) and vols:
         dev_or_folders = mount_volumes(
             api, vols, not args.no_multipath, args.fstype, args.fsargs,
@@ -254,17 +321,32 @@ def main(args):
                 mtypes = ['iops_write']
             data = get_metrics(
                 api, mtypes, args.volume, interval, timeout,
-                args.metrics_op)
+                args.metrics_op, out_file=args.metrics_out_file,
+                fmt=args.metrics_format, rate=args.metrics_rate,
+                group_by=args.metrics_group_by)
         except ValueError:
             print("--metrics argument must be in format '--metrics i,t' where"
                   "'i' is the interval in seconds and 't' is the timeout in "
                   "seconds.  Both must be positive integers >= 1")
             return FAILURE
-        if data:
+        if not data:
+            print("No data recieved from metrics")
+            return FAILURE
+        if args.metrics_format == 'json':
             write_metrics(data, args.metrics_out_file)
         else:
-            print("No data recieved from metrics")
+            print("Wrote {} metric points to: {}".format(
+                data, args.metrics_out_file))
+
+    if args.metrics_from_file:
+        try:
+            data = read_metrics(args.metrics_from_file, args.metrics_op,
+                                rate=args.metrics_rate,
+                                group_by=args.metrics_group_by)
+        except ValueError as e:
+            print(e)
             return FAILURE
+        write_metrics(data, args.metrics_out_file)
     return SUCCESS
 
 
@@ -289,6 +371,10 @@ if __name__ == '__main__':
                                            'media-policy'),
                         action='append', default=[],
                         help='List accessible Datera Resources')
+    parser.add_argument('--list-page-size', type=int,
+                        help=hf('Stream --list volumes/mounts output, '
+                                'fetching this many app_instances per '
+                                'request.  Output is unsorted'))
     parser.add_argument('--clear-alerts', action='store_true')
 
     # This is only used with --list events-id
@@ -307,9 +393,15 @@ if __name__ == '__main__':
                              '    choices: hybrid|single_flash|all_flash\n'
                              '* template, default=None\n'
                              '* object, default=False\n'
+                             '* nested (single request creation), '
+                             'default=True\n'
                              'Example: prefix=test,size=2,replica=2\n \n'
                              'Alternatively a json file with the above\n'
                              'parameters can be specified')
+    parser.add_argument('--reconcile', action='store_true',
+                        help=hf('When some volumes matching --volume already '
+                                'exist, create only the missing ones instead '
+                                'of reusing the existing set as-is'))
     parser.add_argument('--placement-policy', action='append', default=[],
                         help='Supports the following comma separated params:\n'
                              '\n'
@@ -344,6 +436,33 @@ if __name__ == '__main__':
     parser.add_argument('--directory', default='/mnt',
                         help='Directory under which to mount devices')
     parser.add_argument('--no-multipath', action='store_true')
+    parser.add_argument('--tune-profile',
+                        help=hf('Block device tuning applied to every '
+                                'logged in device and its dm-* device.  '
+                                'Choices: {} or the path of a JSON file '
+                                'mapping queue attributes ({}) to values.  '
+                                'The result is verified and reported'.format(
+                                    ', '.join(sorted(tuning.PROFILES)),
+                                    ', '.join(tuning.ATTRS))))
+    parser.add_argument('--iscsi-profile',
+                        help=hf('iSCSI session settings written to each '
+                                'node record before login.  Choices: {} or '
+                                'the path of a JSON file mapping settings '
+                                '({}) to values.  The values each session '
+                                'ended up with are reported'.format(
+                                    ', '.join(sorted(iscsi.SESSION_PROFILES)),
+                                    ', '.join(sorted(iscsi.SESSION_KEYS)))))
+    parser.add_argument('--pipeline', action='store_true',
+                        help=hf('Create, login and mount each volume as soon '
+                                'as its previous step completes instead of '
+                                'waiting for every volume to finish each '
+                                'step'))
+    parser.add_argument('--stage-workers', type=stage_workers_type,
+                        help=hf('Comma separated concurrency limits for '
+                                '--pipeline stages, eg: "create=10,login=4".'
+                                '  Stages: {}.  Unspecified stages use '
+                                '--workers'.format(
+                                    ', '.join(STAGES + CLEAN_STAGES))))
 
     # Resource removal
     parser.add_argument('--logout', action='store_true',
@@ -378,13 +497,34 @@ if __name__ == '__main__':
                         help=hf('Metric to retrieve.  Choices: {}'.format(
                                 json.dumps(METRIC_CHOICES))))
     parser.add_argument('--metrics-op',
-                        choices=(None, 'average', 'max', 'min',
-                                 'total-average', 'total-max', 'total-min'),
-                        help='Operation to perform on metrics data.  For '
-                             'example: Averaging the results')
+                        choices=(None,) + aggregate.OPS,
+                        help=hf('Operation to perform on metrics data.  For '
+                                'example: Averaging the results.  Ops '
+                                'prefixed with "total-" combine every '
+                                'volume.  Choices: {}'.format(
+                                    ', '.join(aggregate.OPS))))
+    parser.add_argument('--metrics-rate', action='store_true',
+                        help=hf('Turn the cumulative counters ({}) into '
+                                'per-second rates before applying '
+                                '--metrics-op'.format(
+                                    ', '.join(aggregate.COUNTERS))))
+    parser.add_argument('--metrics-group-by', choices=aggregate.GROUP_BY,
+                        help=hf('Apply --metrics-op to each group of volumes '
+                                'instead of each volume'))
     parser.add_argument('--metrics-out-file', default='metrics-out.json',
                         help='Output file for metrics report.  Use "stdout" to'
                         ' print metrics to STDOUT')
+    parser.add_argument('--metrics-format', default='json',
+                        choices=('json', 'jsonl', 'csv'),
+                        help=hf('Format of --metrics-out-file.  "json" '
+                                'writes the whole report once sampling '
+                                'ends.  "jsonl" and "csv" append every point '
+                                'to the file as it is collected'))
+    parser.add_argument('--metrics-from-file',
+                        help=hf('Read points streamed by --metrics-format '
+                                'jsonl/csv from this file and write them to '
+                                '--metrics-out-file as a json report, '
+                                'applying --metrics-op'))
 
     # Object store helpers
     parser.add_argument('--get-keys', action='store_true',
@@ -398,8 +538,26 @@ if __name__ == '__main__':
                              ' secrets')
 
     # Misc
-    parser.add_argument('--workers', default=5, type=int,
-                        help='Number of worker threads for this action')
+    parser.add_argument('--cache-max-age', type=int, default=0,
+                        help=hf('Answer read-only lookups (--list, '
+                                '--metrics, unmount/logout) from the local '
+                                'inventory cache if it was refreshed within '
+                                'this many seconds.  0 disables the cache'))
+    parser.add_argument('--workers', default=5, type=workers_type,
+                        help=hf('Number of worker threads for this action.  '
+                                'Use "auto" to adjust the number of '
+                                'in-flight operations based on API latency '
+                                'and errors'))
 
     args = parser.parse_args()
+    # Streamed points are written as they arrive, so there's nothing for the
+    # aggregation flags to work on until the file is read back in
+    aggregating = (args.metrics_op or args.metrics_rate or
+                   args.metrics_group_by)
+    if (args.metrics and args.metrics_format != 'json' and aggregating and
+            not args.metrics_from_file):
+        parser.error("--metrics-op, --metrics-rate and --metrics-group-by "
+                     "can't be used with --metrics-format {}.  Apply them to "
+                     "the streamed file afterwards with --metrics-from-file"
+                     .format(args.metrics_format))
     sys.exit(main(args))
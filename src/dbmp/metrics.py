@@ -1,13 +1,33 @@
 from __future__ import (unicode_literals, print_function, absolute_import,
                         division)
 
+import array
+import csv
 import io
 import json
+import math
+import os
 import sys
+import threading
 import time
 
+import six
+from concurrent import futures
+from dfs_sdk import exceptions as dat_exceptions
+
+from dbmp.aggregate import INT64, apply_op, group_keys
 from dbmp.volume import ais_from_vols
-from dbmp.utils import Parallel, dprint
+from dbmp.utils import dprint, monotonic
+
+# Concurrent metric requests per interval
+METRIC_WORKERS = 16
+# App_instance uuids per bulk metric request
+BULK_SIZE = 100
+# Seconds between fsyncs of a streamed metrics file
+SYNC_INTERVAL = 10
+# Columns of a streamed metrics file
+SINK_FIELDS = ('app_instance', 'metric', 'tick', 'time', 'local_time',
+               'value')
 
 # Python 2/3 compat
 try:
@@ -16,27 +36,94 @@ except NameError:
     unicode = str
 
 
-def get_metrics(api, metrics, vols, interval, timeout, op):
+class Series(object):
+
+    """
+    One metric of one app_instance, stored as typed columns instead of a
+    list of point dicts: the tick each point belongs to, the array's
+    timestamp and the value.  Values are kept as int64 until a non-integer
+    arrives.  The local time of each tick is shared by every Series of a run
+    through `local_times`, which is indexed by tick
+    """
+
+    __slots__ = ('ticks', 'times', 'values', 'local_times')
+
+    def __init__(self, local_times):
+        self.ticks = array.array(str('i'))
+        self.times = array.array(INT64)
+        self.values = array.array(INT64)
+        self.local_times = local_times
+
+    def append(self, tick, point):
+        value = point['value']
+        if self.values.typecode == INT64 and not isinstance(
+                value, six.integer_types):
+            self.values = array.array(str('d'), self.values)
+        self.ticks.append(tick)
+        self.times.append(point.get('time') or 0)
+        self.values.append(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def points(self):
+        """ Returns the points as the dicts the API returned them as """
+        return [{'time': t, 'value': v, 'tick': tick,
+                 'local_time': self.local_times[tick]}
+                for tick, t, v in zip(self.ticks, self.times, self.values)]
+
+    def nbytes(self):
+        """ Bytes used by this Series' own columns """
+        return sum(c.itemsize * len(c)
+                   for c in (self.ticks, self.times, self.values))
+
+
+def _set_local_time(local_times, tick, local_time):
+    # Skipped ticks never get a local time
+    while len(local_times) <= tick:
+        local_times.append(float('nan'))
+    local_times[tick] = local_time
+
+
+def get_metrics(api, metrics, vols, interval, timeout, op,
+                workers=METRIC_WORKERS, out_file=None, fmt='json',
+                rate=False, group_by=None):
+    """
+    Samples metrics for every app_instance matching `vols`.  With the 'json'
+    format the points are returned with `op` applied (see
+    aggregate.apply_op for `rate` and `group_by`).  With 'jsonl' or 'csv'
+    each point is appended to `out_file` as it arrives and the number of
+    points written is returned instead
+    """
     ais = []
     for vol in vols:
-        ais.extend(ais_from_vols(api, vol))
-    results = {ai.name: {metric: [] for metric in metrics} for ai in ais}
-    args = [(api, results, ai, metrics, interval, timeout) for ai in ais]
-    funcs = [_get_metric for _ in ais]
-    p = Parallel(funcs, args_list=args, max_workers=len(funcs))
-    p.run_threads()
-    if op == 'average':
-        _do_average(results)
-    elif op == 'max':
-        _do_max(results)
-    elif op == 'min':
-        _do_min(results)
-    elif op == 'total-average':
-        _do_total_average(results)
-    elif op == 'total-max':
-        _do_total_max(results)
-    elif op == 'total-min':
-        _do_total_min(results)
+        ais.extend(ais_from_vols(api, vol, cached=True))
+    if fmt != 'json':
+        print("Streaming metrics data to:", out_file)
+        sink = MetricSink(out_file, fmt)
+        try:
+            _poll_metrics(api, None, ais, metrics, interval, timeout,
+                          workers, sink)
+        finally:
+            sink.close()
+        return sink.count
+    local_times = array.array(str('d'))
+    results = {ai.name: {metric: Series(local_times) for metric in metrics}
+               for ai in ais}
+    _poll_metrics(api, results, ais, metrics, interval, timeout, workers,
+                  local_times=local_times)
+    series = [sr for v1 in results.values() for sr in v1.values()]
+    dprint("Metric columns hold {} points in {} bytes".format(
+        sum(len(sr) for sr in series),
+        sum(sr.nbytes() for sr in series) +
+        local_times.itemsize * len(local_times)))
+    groups = None
+    if group_by:
+        snodes = None
+        if group_by == 'storage_node':
+            snodes = {sn.uuid: sn.name for sn in api.storage_nodes.list()}
+        groups = group_keys(ais, group_by, snodes)
+    apply_op(results, op, rate=rate, groups=groups)
     return results
 
 
@@ -44,68 +131,267 @@ def write_metrics(data, outfile):
     print("Writing metrics data to:", outfile)
     if outfile == 'stdout':
         f = sys.stdout
-        f.write(unicode(json.dumps(data, indent=4)))
+        f.write(unicode(json.dumps(data, indent=4, default=_encode)))
     else:
         with io.open(outfile, 'w+', encoding='utf-8') as f:
-            f.write(unicode(json.dumps(data, indent=4)))
+            f.write(unicode(json.dumps(data, indent=4, default=_encode)))
+
+
+def _encode(obj):
+    # Series are only expanded to point dicts while they're being written
+    if isinstance(obj, Series):
+        return obj.points()
+    raise TypeError("{!r} is not JSON serializable".format(obj))
+
+
+def read_metrics(infile, op, rate=False, group_by=None):
+    """
+    Reads points written by a MetricSink back into the nested structure
+    get_metrics returns and applies `op` to them.  Only the app_instance
+    names are in the file, so it can only be grouped by prefix
+    """
+    if group_by not in (None, 'prefix'):
+        raise ValueError("Points read from a file can only be grouped by "
+                         "prefix")
+    results = {}
+    local_times = array.array(str('d'))
+    with io.open(infile, encoding='utf-8') as f:
+        # JSON lines start with '{', CSV files with their header
+        if f.read(1) == '{':
+            f.seek(0)
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            f.seek(0)
+            rows = csv.DictReader(f)
+        for row in rows:
+            point = {k: _number(row[k]) for k in SINK_FIELDS[2:]}
+            _set_local_time(local_times, point['tick'],
+                            point['local_time'] or float('nan'))
+            series = results.setdefault(row['app_instance'], {})
+            if row['metric'] not in series:
+                series[row['metric']] = Series(local_times)
+            series[row['metric']].append(point['tick'], point)
+    groups = None
+    if group_by:
+        groups = group_keys([{'name': name} for name in results], group_by)
+    apply_op(results, op, rate=rate, groups=groups)
+    return results
+
+
+def _number(v):
+    if isinstance(v, (int, float)) or v in (None, ''):
+        return v
+    try:
+        return int(v)
+    except ValueError:
+        return float(v)
+
+
+class MetricSink(object):
+
+    """
+    Appends each metric point to a file as a JSON line or CSV row.  The file
+    is flushed after every tick and fsynced at most every `sync_interval`
+    seconds, so an interrupted run keeps everything up to the last tick
+    """
+
+    def __init__(self, path, fmt, sync_interval=SYNC_INTERVAL):
+        self.path = path
+        self.fmt = fmt
+        self.sync_interval = sync_interval
+        self.count = 0
+        self._synced = monotonic()
+        if path == 'stdout':
+            self.f = sys.stdout
+        elif six.PY2:
+            # The python 2 csv module only writes to byte streams
+            self.f = open(path, 'ab')
+        else:
+            self.f = io.open(path, 'a', encoding='utf-8', newline='')
+        self.writer = None
+        if fmt == 'csv':
+            self.writer = csv.DictWriter(self.f, fieldnames=SINK_FIELDS)
+            if path == 'stdout' or not self.f.tell():
+                self.writer.writeheader()
+
+    def add(self, ai_name, metric, point):
+        row = {'app_instance': ai_name, 'metric': metric}
+        row.update((k, point.get(k)) for k in SINK_FIELDS[2:])
+        if self.writer:
+            self.writer.writerow(row)
+        else:
+            self.f.write(unicode(json.dumps(row)) + '\n')
+        self.count += 1
 
+    def flush(self):
+        self.f.flush()
+        if self.f is sys.stdout:
+            return
+        if monotonic() - self._synced >= self.sync_interval:
+            os.fsync(self.f.fileno())
+            self._synced = monotonic()
 
-def _get_metric(api, results, ai, metrics, interval, timeout):
-    eps = [(getattr(api.metrics.io, metric), metric) for metric in metrics]
-    while timeout > 0:
-        for ep, metric in eps:
-            dprint("Getting metric {} data from ai {}".format(metric, ai.name))
-            data = ep.latest.get(uuid=ai.id)[0]['point']
-            results[ai.name][metric].append(data)
-        time.sleep(interval)
-        timeout -= interval
+    def close(self):
+        if self.f is sys.stdout:
+            self.f.flush()
+            return
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
 
 
-def _do_average(results):
-    _func_helper(results, _average)
+def _poll_metrics(api, results, ais, metrics, interval, timeout, workers,
+                  sink=None, local_times=None):
+    """
+    Samples every metric of every app_instance on each SampleClock tick.  One
+    loop schedules the ticks and a pool of `workers` threads makes the
+    requests, so the thread count doesn't grow with the number of
+    app_instances.  Each point gets the tick it belongs to and the local
+    time it was collected at alongside the array's own timestamp.  Points go
+    to `sink` if one is given, otherwise they're appended to the Series in
+    `results` and each tick's local time to `local_times`
+    """
+    if not ais or not metrics:
+        return
+    fetcher = MetricFetcher(api, metrics, ais)
+    clock = SampleClock(interval, timeout)
+    pool = futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        for tick in clock:
+            samples = fetcher.sample(pool)
+            local_time = time.time()
+            if sink:
+                for ai, metric, point in samples:
+                    sink.add(ai.name, metric, dict(
+                        point, tick=tick, local_time=local_time))
+                sink.flush()
+            else:
+                _set_local_time(local_times, tick, local_time)
+                for ai, metric, point in samples:
+                    results[ai.name][metric].append(tick, point)
+            dprint("Metric requests for tick {}: {}".format(
+                tick, fetcher.requests[-1]))
+    finally:
+        pool.shutdown(wait=True)
+    fetcher.report()
+    clock.report()
 
 
-def _do_max(results):
-    _func_helper(results, max)
+class SampleClock(object):
 
+    """
+    Yields tick numbers on a fixed schedule of `interval` seconds from the
+    first tick, measured with a monotonic clock, until `timeout` seconds of
+    ticks have been yielded.
 
-def _do_min(results):
-    _func_helper(results, min)
+    A tick is only yielded on time.  If sampling runs past one or more tick
+    boundaries those ticks are recorded in `skipped` and the next tick keeps
+    its original slot, so every series stays aligned to the same boundaries.
+    """
 
+    def __init__(self, interval, timeout):
+        self.interval = interval
+        self.ticks = int(math.ceil(timeout / interval))
+        self.skipped = []
 
-def _do_total_average(results):
-    _total_helper(results, _average)
+    def __iter__(self):
+        start = monotonic()
+        tick = 0
+        while tick < self.ticks:
+            delay = start + tick * self.interval - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            yield tick
+            # The boundary most recently passed, any ticks after the one
+            # just sampled up to and including it are already late
+            passed = int((monotonic() - start) // self.interval)
+            late = list(range(tick + 1, min(passed, self.ticks - 1) + 1))
+            if late:
+                dprint("Sampling ran late, skipping ticks:", late)
+                self.skipped.extend(late)
+            tick = max(tick, passed) + 1
 
+    def report(self):
+        if self.skipped:
+            print("Skipped {} of {} metric ticks because sampling took longer "
+                  "than the interval".format(len(self.skipped), self.ticks))
 
-def _do_total_max(results):
-    _total_helper(results, max)
 
+class MetricFetcher(object):
 
-def _do_total_min(results):
-    _total_helper(results, min)
+    """
+    Fetches the latest point of each metric for a set of app_instances.
 
+    Each metric endpoint is first asked for BULK_SIZE uuids at a time in one
+    comma separated request.  If that request fails or leaves uuids out of
+    the answer, that metric falls back to one request per uuid for the rest
+    of the run.  App_instances listed more than once are only requested once.
+    """
 
-def _average(v):
-    return int(sum(v) / len(v))
+    def __init__(self, api, metrics, ais, batch=BULK_SIZE):
+        self.eps = [(metric, getattr(api.metrics.io, metric))
+                    for metric in metrics]
+        self.ais = {}
+        for ai in ais:
+            self.ais.setdefault(ai.id, ai)
+        self.uuids = sorted(self.ais)
+        self.batch = batch
+        self.bulk = {metric: True for metric in metrics}
+        # Requests made during each interval
+        self.requests = []
+        self._lock = threading.Lock()
 
+    def sample(self, pool):
+        """ Returns an (ai, metric, point) tuple for every point fetched """
+        self.requests.append(0)
+        jobs = []
+        for metric, ep in self.eps:
+            size = self.batch if self.bulk[metric] else 1
+            for i in range(0, len(self.uuids), size):
+                jobs.append((metric, ep, self.uuids[i:i + size]))
+        samples = []
+        for metric, points in pool.map(self._fetch, jobs):
+            for uuid, point in points:
+                samples.append((self.ais[uuid], metric, point))
+        return samples
 
-def _func_helper(results, func):
-    for name, v1 in results.items():
-        for m, v2 in v1.items():
-            v = [elem['value'] for elem in v2]
-            results[name][m] = func(v)
+    def _get(self, ep, uuids):
+        with self._lock:
+            self.requests[-1] += 1
+        return ep.latest.get(uuid=",".join(uuids))
 
+    def _fetch(self, job):
+        metric, ep, uuids = job
+        if len(uuids) > 1 and self.bulk[metric]:
+            try:
+                points = {e['uuid']: e['point']
+                          for e in self._get(ep, uuids) if 'uuid' in e}
+                if all(uuid in points for uuid in uuids):
+                    return metric, [(uuid, points[uuid]) for uuid in uuids]
+                dprint("Bulk request for {} was missing uuids".format(metric))
+            except dat_exceptions.ApiError as e:
+                # Some arrays answer a comma separated uuid with a 404 or 500
+                # rather than a 400, any of them means no bulk requests
+                dprint("Bulk request for {} failed: {}".format(metric, e))
+            with self._lock:
+                if self.bulk[metric]:
+                    print("Fetching {} one app_instance at a time".format(
+                        metric))
+                self.bulk[metric] = False
+        points = []
+        for uuid in uuids:
+            data = self._get(ep, [uuid])
+            if not data:
+                dprint("No {} data for app_instance {}".format(
+                    metric, self.ais[uuid].name))
+                continue
+            points.append((uuid, data[0]['point']))
+        return metric, points
 
-def _total_helper(results, func):
-    newr = {}
-    for name, v1 in results.items():
-        for m, v2 in v1.items():
-            name = 'total_min_{}'.format(m)
-            if name not in results:
-                newr[name] = []
-            newr[name].extend([elem['value'] for elem in v2])
-    for k, v in newr.items():
-        newr[k] = func(v)
-    for k in results.keys():
-        del results[k]
-    results.update(newr)
+    def report(self):
+        if not self.requests:
+            return
+        print("Made {:.1f} metric requests per interval for {} app_instances "
+              "over {} intervals".format(
+                  sum(self.requests) / len(self.requests), len(self.uuids),
+                  len(self.requests)))
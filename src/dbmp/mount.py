@@ -1,18 +1,35 @@
 from __future__ import unicode_literals, print_function, division
 
-import glob
 import os
 import time
 import sys
 import re
+import threading
 
 from dfs_sdk import exceptions as dat_exceptions
 
-from dbmp.volume import ais_from_vols, parse_vol_opt
-from dbmp.utils import Parallel, exe
-from dbmp.utils import get_hostname, dprint, locker
+from dbmp.devices import INITIATOR_FILE, read_initiator_name
+from dbmp.devices import read_mounts, resolve_device
+from dbmp.devices import DM_INDEX, WATCHER, target_links
+from dbmp.iscsi import DISCOVERY, SESSIONS
+from dbmp.pipeline import Pipeline, Stage
+from dbmp.readiness import SI_READY
+from dbmp.tuning import TUNER
+from dbmp.volume import ais_from_vols, parse_vol_opt, _create_volume
+from dbmp.volume import ai_sis, list_ais
+from dbmp.volume import _create_complex_volume, reconcile_volumes
+from dbmp.utils import FuturesParallel, exe, monotonic
+from dbmp.utils import get_hostname, dprint, locker, retry
 
 DEV_TEMPLATE = "/dev/disk/by-path/ip-{ip}:3260-iscsi-{iqn}-lun-{lun}"
+STAGES = ('create', 'acl', 'login', 'mkfs', 'mount')
+CLEAN_STAGES = ('unmount', 'logout')
+# Initiator entity for each tenant, looked up once per run
+INITIATORS = {}
+# Seconds to wait for a device to appear or disappear
+DEVICE_TIMEOUT = 60
+# Seconds to keep retrying mkfs on a device that isn't ready yet
+MKFS_TIMEOUT = 5
 
 # Py 2/3 compat
 try:
@@ -21,77 +38,144 @@ except NameError:
     pass
 
 
-def clean_mounts(api, vols, directory, workers):
-    ais = ais_from_vols(api, vols)
-    funcs, args = [], []
+def clean_mounts(api, vols, directory, workers, stage_workers=None):
+    """
+    Unmounts and logs out of every matching volume.  Unmounts run through
+    their own worker pool and a target is logged out as soon as all of its
+    volumes are unmounted.  stage_workers maps the CLEAN_STAGES names to
+    their concurrency limits and defaults to `workers` for both
+    """
+    stage_workers = stage_workers or {s: workers for s in CLEAN_STAGES}
+    ais = ais_from_vols(api, vols, cached=True)
+    targets, items, pending = [], [], {}
+    lock = threading.Lock()
     for ai in ais:
-        for si in ai.storage_instances.list():
-            iqn = si.access.get('iqn')
+        for si in ai_sis(ai):
+            iqn = si['access'].get('iqn')
             dprint("Cleaning {},{} portals {}, iqn {}".format(
-                ai.name, si.name, si.access['ips'], si.access.get('iqn')))
+                ai['name'], si['name'], si['access'].get('ips'), iqn))
             if not iqn:
                 dprint("{},{} did not have an iqn field".format(
-                    ai.name, si.name))
+                    ai['name'], si['name']))
                 continue
-            portals = si.access['ips']
-            for vol in si.volumes.list():
-                _unmount(ai.name, si.name, vol.name, directory)
-            funcs.append(_logout)
-            args.append((iqn, portals))
-    if funcs:
-        p = Parallel(funcs, args_list=args)
-        p.run_threads()
+            target = (iqn, si['access']['ips'])
+            targets.append(target)
+            pending[iqn] = len(si['volumes'])
+            for vol in si['volumes']:
+                items.append((ai['name'], si['name'], vol['name'], target))
+            if not si['volumes']:
+                items.append((ai['name'], si['name'], None, target))
+
+    def _do_unmount(item):
+        ai_name, si_name, vol_name, target = item
+        if vol_name:
+            _unmount(ai_name, si_name, vol_name, directory)
+        with lock:
+            pending[target[0]] -= 1
+            if pending[target[0]] > 0:
+                return []
+        return [target]
+
+    def _do_logout(target):
+        _logout_target(*target)
+        return [target]
+
+    if items:
+        p = Pipeline([
+            Stage('unmount', _do_unmount, stage_workers['unmount']),
+            Stage('logout', _do_logout, stage_workers['logout'])])
+        p.run(items)
+        p.report()
+    _finish_logout(targets)
 
 
 def _unmount(ai_name, si_name, vol_name, directory):
     folder = get_dirname(directory, ai_name, si_name, vol_name)
+    start = monotonic()
     try:
         exe("sudo umount {}".format(folder))
     except EnvironmentError as e:
         dprint(e)
         return
     exe("sudo rmdir {}".format(folder))
+    print("Unmounted {} in {:.2f}s".format(folder, monotonic() - start))
 
 
 def mount_volumes(api, vols, multipath, fs, fsargs, directory, workers,
                   login_only, force_init, initiator_path):
     funcs, args = [], []
     results = []
+    acl = None
+    if vols:
+        acl = _acl_target(api, force_init, initiator_path)
     for ai in vols:
         funcs.append(_mount_volume)
         args.append((api, ai, multipath, fs, fsargs, directory, login_only,
-                     results, force_init, initiator_path))
+                     acl))
     if funcs:
-        p = Parallel(funcs, args_list=args, max_workers=workers)
-        p.run_threads()
+        p = FuturesParallel(funcs, args_list=args, max_workers=workers)
+        for dev_or_folders in p.run_threads():
+            results.extend(dev_or_folders)
+        _report_stats()
     return results
 
 
+def _report_stats():
+    print("iSCSI discovery ran {} times for {} portals".format(
+        DISCOVERY.calls, len(DISCOVERY.targets)))
+    print("Readiness polling made {} API calls for {} storage_instances"
+          .format(SI_READY.calls, SI_READY.ready))
+    TUNER.report()
+    SESSIONS.report()
+
+
 def get_dirname(directory, ai_name, si_name, vol_name):
     return os.path.join(directory, "-".join((ai_name, si_name, vol_name)))
 
 
 def _mount_volume(api, ai, multipath, fs, fsargs, directory, login_only,
-                  results, force_init, initiator_path):
-    _setup_acl(api, ai, force_init, initiator_path)
-    ai.set(admin_state='online')
-    for si in ai.storage_instances.list():
-        _si_poll(si)
-        si = si.reload()
+                  acl):
+    results = []
+    for si, i, vol in _prepare_ai(api, ai, acl):
         ac = si.access
-        for i, vol in enumerate(si.volumes.list()):
-            path = _login(ac['iqn'], ac['ips'], multipath, i)
-            if login_only:
-                results.append(path)
-            print("Volume device path:", path)
-            if not login_only:
-                folder = get_dirname(directory, ai.name, si.name, vol.name)
-                results.append(folder)
-                _format_mount_device(path, fs, fsargs, folder)
+        path = _login(ac['iqn'], ac['ips'], multipath, i)
+        if login_only:
+            results.append(path)
+        print("Volume device path:", path)
+        if not login_only:
+            folder = get_dirname(directory, ai.name, si.name, vol.name)
+            results.append(folder)
+            _format_mount_device(path, fs, fsargs, folder)
+    return results
+
+
+def _prepare_ai(api, ai, acl):
+    """
+    Sets up ACLs and onlines the app_instance, then waits for each
+    storage_instance to become available.  Returns a (si, lun, vol) tuple for
+    every volume ready to be logged into
+    """
+    _setup_acl(ai, acl)
+    # These are safe to repeat, so transient API errors are retried here
+    retry(ai.set, kwargs={'admin_state': 'online'})
+    vols = []
+    for si in retry(ai.storage_instances.list):
+        SI_READY.wait(api, si)
+        si = retry(si.reload)
+        for i, vol in enumerate(retry(si.volumes.list)):
+            vols.append((si, i, vol))
+    return vols
 
 
 def _format_mount_device(path, fs, fsargs, folder):
-    timeout = 5
+    _format_device(path, fs, fsargs)
+    _mount_device(path, folder)
+
+
+def _format_device(path, fs, fsargs):
+    if not WATCHER.wait_for(lambda: resolve_device(path), DEVICE_TIMEOUT):
+        raise EnvironmentError("Device never appeared: {}".format(path))
+    deadline = monotonic() + MKFS_TIMEOUT
     while True:
         try:
             exe("sudo mkfs.{} {} {} ".format(fs, fsargs, path))
@@ -112,53 +196,120 @@ def _format_mount_device(path, fs, fsargs, folder):
                 pass
             dprint("Failed to format {}. Waiting for device to be "
                    "ready".format(path))
-            if not timeout:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
                 raise
-            time.sleep(1)
-            timeout -= 1
+            # Device events cut the wait short, so the budget is kept in
+            # seconds rather than in wake-ups
+            WATCHER.wait_change(min(remaining, 1))
+
+
+def _mount_device(path, folder):
     exe("sudo mkdir -p /{}".format(folder.strip("/")))
     exe("sudo mount {} {}".format(path, folder))
     print("Volume mount:", folder)
 
 
-def _si_poll(si):
-    timeout = 10
-    while True:
-        si = si.reload()
-        if si.op_state == 'available':
-            break
-        if not timeout:
-            raise EnvironmentError(
-                "Polling ended before storage_instance {} was still "
-                "unavailable".format(si.path))
-        time.sleep(1)
-        timeout -= 1
+def pipeline_volumes(host, api, vopt, multipath, fs, fsargs, directory,
+                     stage_workers, login_only, force_init, initiator_path,
+                     reconcile=False):
+    """
+    Creates, logs into and mounts volumes as a streaming pipeline.  Each
+    volume moves on to its next stage as soon as its previous stage is done
+    instead of waiting for every volume to finish that stage.
+
+    stage_workers maps stage names in STAGES to their concurrency limit
+    """
+    hostname = get_hostname(host)
+    opts = parse_vol_opt(vopt)
+
+    def _create(item):
+        # Volumes found while reconciling are passed through as-is
+        if not isinstance(item, int):
+            return [item]
+        ai, _ = _create_volume(hostname, api, opts, item)
+        return [ai]
+
+    def _acl(ai):
+        return [(ai, si, i, vol) for si, i, vol in _prepare_ai(
+            api, ai, acl)]
+
+    def _do_login(item):
+        ai, si, i, vol = item
+        ac = si.access
+        path = _login(ac['iqn'], ac['ips'], multipath, i)
+        print("Volume device path:", path)
+        if login_only:
+            return [path]
+        return [(path, get_dirname(directory, ai.name, si.name, vol.name))]
+
+    def _mkfs(item):
+        _format_device(item[0], fs, fsargs)
+        return [item]
+
+    def _mount(item):
+        path, folder = item
+        _mount_device(path, folder)
+        return [folder]
+
+    funcs = {'create': _create, 'acl': _acl, 'login': _do_login,
+             'mkfs': _mkfs, 'mount': _mount}
+    names = list(STAGES)
+    items = ais_from_vols(api, vopt)
+    if items and reconcile and 'sis' not in opts:
+        existing, missing = reconcile_volumes(opts, items)
+        print("Found {} existing volumes, creating {} missing".format(
+            len(existing), len(missing)))
+        items = list(existing.values()) + missing
+    elif items:
+        # If they already exist lets just use them
+        names.remove('create')
+    elif 'sis' in opts:
+        names.remove('create')
+        items = [_create_complex_volume(api, opts)]
+    else:
+        items = range(int(opts['count']))
+    if login_only:
+        names = names[:names.index('login') + 1]
+    acl = _acl_target(api, force_init, initiator_path)
+    p = Pipeline([Stage(n, funcs[n], stage_workers[n]) for n in names])
+    results = p.run(items)
+    p.report()
+    _report_stats()
+    return results
 
 
 def _get_initiator():
-    file_path = '/etc/iscsi/initiatorname.iscsi'
     try:
-        out = exe('sudo cat {}'.format(file_path))
-        for line in out.splitlines():
-            if line.startswith('InitiatorName='):
-                return line.split("=", 1)[-1].strip()
+        return read_initiator_name()
     except EnvironmentError:
-        dprint("Could not find the iSCSI Initiator File %s", file_path)
+        dprint("Could not find the iSCSI Initiator File", INITIATOR_FILE)
         raise
 
 
-@locker
 def _setup_initiator(api, force):
+    """
+    Returns the initiator entity for this host, creating it if needed.  It's
+    only looked up once per tenant for the whole run
+    """
+    tenant = api.context.tenant or '/root'
+    if tenant not in INITIATORS:
+        _lookup_initiator(api, tenant, force)
+    return INITIATORS[tenant]
+
+
+@locker
+def _lookup_initiator(api, tenant, force):
+    # Another worker may have finished the lookup while we waited
+    if tenant in INITIATORS:
+        return
     initiator = _get_initiator()
-    host = exe('hostname').strip()
+    host = get_hostname('local')
     initiator_obj = None
     try:
         initiator_obj = api.initiators.get(initiator)
         # Handle case where initiator exists in parent tenant
         # We want to create a new initiator in the case
-        tenant = api.context.tenant
-        if not tenant:
-            tenant = '/root'
         if initiator_obj.tenant != tenant:
             raise dat_exceptions.ApiNotFoundError(msg="Non matching tenant")
     except dat_exceptions.ApiNotFoundError:
@@ -182,82 +333,77 @@ def _setup_initiator(api, force):
                         sys.exit(1)
                 else:
                     raise
-    return initiator_obj
-
-
-def _setup_acl(api, ai, force_init, initiator_path):
-    if initiator_path == 'local':
-        initiatorObj = _setup_initiator(api, force_init)
-        initiator = initiatorObj.path
-    else:
-        initiator = initiator_path
-    #Check to see if the initiator is group to use the right api call
-    if re.match(".*groups.*",initiator):
-        for si in ai.storage_instances.list():
-            try:
-                si.acl_policy.initiator_groups.add(initiator)
-            except dat_exceptions.ApiConflictError:
-                dprint("ACL Group already registered for {},{}".format(ai.name, si.name))
-    else:
-        for si in ai.storage_instances.list():
-            try:
-                si.acl_policy.initiators.add(initiator)
-            except dat_exceptions.ApiConflictError:
-                dprint("ACL already registered for {},{}".format(ai.name, si.name))
-        dprint("Setting up ACLs for {} targets".format(ai.name))
-
+    INITIATORS[tenant] = initiator_obj
+
+
+def _acl_target(api, force_init, initiator_path):
+    """
+    Resolves the initiator or initiator group path to add to the ACL of each
+    storage_instance being mounted
+    """
+    if initiator_path != 'local':
+        return initiator_path
+    return _setup_initiator(api, force_init).path
+
+
+def _setup_acl(ai, acl):
+    """
+    Adds initiator or initiator group path `acl` to the ACL of every
+    storage_instance of `ai` that doesn't already have it
+    """
+    kind = 'initiator_groups' if re.match(".*groups.*", acl) else 'initiators'
+    names = set()
+    for si in ai_sis(ai):
+        policy = si.get('acl_policy') or {}
+        if acl not in [e['path'] for e in policy.get(kind, [])]:
+            names.add(si['name'])
+    if not names:
+        dprint("ACLs already set up for {}".format(ai['name']))
+        return
+    dprint("Setting up ACLs for {} targets".format(ai['name']))
+    for si in ai.storage_instances.list():
+        if si.name not in names:
+            continue
+        try:
+            getattr(si.acl_policy, kind).add(acl)
+        except dat_exceptions.ApiConflictError:
+            dprint("ACL already registered for {},{}".format(
+                ai.name, si.name))
 
 
 def _get_multipath_disk(path):
-    # Follow link to destination directory
-    try:
-        device_path = os.readlink(path)
-    except OSError as e:
-        dprint("Error reading link: {}. error: {}".format(path, e))
+    # Follow link to destination device
+    sdevice = resolve_device(path)
+    if not sdevice:
+        dprint("Error reading link: {}".format(path))
         return
-    sdevice = os.path.basename(device_path)
     # If destination directory is already identified as a multipath device,
     # just return its path
     if sdevice.startswith("dm-"):
         return path
-    # Fallback to iterating through all the entries under /sys/block/dm-* and
-    # check to see if any have an entry under /sys/block/dm-*/slaves matching
-    # the device the symlink was pointing at
-    timeout = 10
-    while timeout > 0:
-        dmpaths = glob.glob("/sys/block/dm-*")
-        for dmpath in dmpaths:
-            sdevices = glob.glob(os.path.join(dmpath, "slaves", "*"))
-            for spath in sdevices:
-                s = os.path.basename(spath)
-                if sdevice == s:
-                    # We've found a matching entry, return the path for the
-                    # dm-* device it was found under
-                    p = os.path.join("/dev", os.path.basename(dmpath))
-                    dprint("Found matching device: {} under dm-* device path "
-                           "{}".format(sdevice, dmpath))
-                    return p
-        timeout -= 1
-        time.sleep(1)
+    # Otherwise find the dm-* device with a slave matching the device the
+    # symlink was pointing at
+    dm = WATCHER.wait_for(lambda: DM_INDEX.lookup(sdevice), 10)
+    if dm:
+        dprint("Found matching device: {} under dm-* device {}".format(
+            sdevice, dm))
+        return os.path.join("/dev", dm)
     raise EnvironmentError(
-        "Couldn't find dm-* path for path: {}, found non dm-* path: {}".format(
-            path, device_path))
+        "Couldn't find dm-* path for path: {}, found non dm-* device: "
+        "{}".format(path, sdevice))
 
 
-def _set_noop_scheduler(portals, iqn, lun):
+def _tune_devices(portals, iqn, lun):
     for portal in portals:
         path = DEV_TEMPLATE.format(ip=portal, iqn=iqn, lun=lun)
-        device = None
-        while True:
-            out = exe("ls -l {} | awk '{{print $NF}}'".format(path))
-            device = out.split("/")[-1].strip()
-            if device:
-                break
-            dprint("Waiting for device to be ready:", path)
-            time.sleep(1)
-        dprint("Setting noop scheduler for device:", device)
-        exe("echo 'noop' | sudo tee /sys/block/{}/queue/scheduler".format(
-            device))
+        dprint("Waiting for device to be ready:", path)
+        device = WATCHER.wait_for(lambda: resolve_device(path),
+                                  DEVICE_TIMEOUT)
+        if not device:
+            raise EnvironmentError(
+                "Device never appeared: {}".format(path))
+        TUNER.tune(device)
+        SESSIONS.record(iqn, portal, device)
 
 
 def _login(iqn, portals, multipath, lun):
@@ -266,11 +412,14 @@ def _login(iqn, portals, multipath, lun):
         portals = [portals[0]]
     if lun == 0:
         for portal in portals:
+            refresh = False
             while True:
                 dprint("Trying to log into target:", portal)
                 try:
-                    exe("sudo iscsiadm -m discovery -t st -p {}:3260".format(
-                        portal))
+                    DISCOVERY.ensure(portal, iqn, refresh=refresh)
+                    # Rediscover if the cached node record didn't work
+                    refresh = True
+                    SESSIONS.apply(iqn, portal)
                     exe("sudo iscsiadm -m node -T {iqn} -p {ip}:3260 "
                         "--login".format(iqn=iqn, ip=portal))
                     break
@@ -284,34 +433,54 @@ def _login(iqn, portals, multipath, lun):
                         raise
                     dprint("Failed to login to portal, retrying")
                     time.sleep(2)
-    _set_noop_scheduler(portals, iqn, lun)
+    _tune_devices(portals, iqn, lun)
     path = DEV_TEMPLATE.format(ip=portals[0], iqn=iqn, lun=lun)
     if multipath:
-        dprint('Sleeping to allow for multipath devices to finish linking')
-        time.sleep(2)
         dpath = _get_multipath_disk(path)
+        TUNER.tune(resolve_device(dpath))
     else:
         dpath = path
     return dpath
 
 
-def _logout(iqn, portals):
+def _logout_target(iqn, portals):
     for portal in portals:
         exe("sudo iscsiadm -m node -T {iqn} -p {ip}:3260 --logout".format(
             iqn=iqn, ip=portal), fail_ok=True)
         exe("sudo iscsiadm -m node -T {iqn} -p {ip}:3260 --op delete".format(
             iqn=iqn, ip=portal), fail_ok=True)
+
+
+def _finish_logout(targets):
+    """
+    Cleans up after _logout_target has run for every target: removes
+    discovery records, rescans sessions and flushes multipath once, then
+    waits for the targets' devices to go away
+    """
+    if not targets:
+        return
+    portals = set()
+    for _, tportals in targets:
+        portals.update(tportals)
+    for portal in sorted(portals):
         exe("sudo iscsiadm -m discoverydb -p {ip}:3260 --op delete".format(
             ip=portal),
             fail_ok=True)
+        DISCOVERY.forget(portal)
     exe("sudo iscsiadm -m session --rescan", fail_ok=True)
     exe("sudo multipath -F", fail_ok=True)
-    dprint("Sleeping to wait for logout")
-    time.sleep(2)
-    dprint("Logout complete")
+    dprint("Waiting for logout")
+    iqns = [iqn for iqn, _ in targets]
+    gone = WATCHER.wait_for(
+        lambda: not any(target_links(iqn) for iqn in iqns), DEVICE_TIMEOUT)
+    if gone:
+        dprint("Logout complete for {} targets".format(len(targets)))
+    else:
+        dprint("Devices still present after logout:",
+               [iqn for iqn in iqns if target_links(iqn)])
 
 
-def list_mounts(host, api, vopt, detail, multipath):
+def list_mounts(host, api, vopt, detail, multipath, page_size=None):
     opts = parse_vol_opt(vopt)
     hostname = get_hostname(host)
     if detail:
@@ -320,31 +489,32 @@ def list_mounts(host, api, vopt, detail, multipath):
     else:
         print("\nMOUNTS")
         print("------")
-    for ai in sorted(api.app_instances.list(), key=lambda x: x.name):
-        if (opts.get('prefix') == 'all' or
-                opts.get('name') == ai.name or
-                ai.name.startswith(opts.get('prefix', hostname))):
-            for si in ai.storage_instances.list():
-                for i, vol in enumerate(si.volumes.list()):
-                    mount, path, device = _find_mount(ai, si, i, multipath)
-                    if mount and detail:
-                        print(",".join((ai.name, si.name, vol.name)),
-                              ":", mount, ":", path, ":", device)
-                    elif mount:
-                        print(",".join((ai.name, si.name, vol.name)),
-                              ":", mount)
-
-
-def _find_mount(ai, si, lun, multipath):
-    ip = si.access['ips'][0]
-    iqn = si.access['iqn']
+    ais = list_ais(api, opts, hostname, page_size)
+    if not page_size:
+        ais = sorted(ais, key=lambda x: x['name'])
+    mounts = read_mounts()
+    for ai in ais:
+        for si in ai_sis(ai):
+            for i, vol in enumerate(si['volumes']):
+                mount, path, device = _find_mount(
+                    ai, si, i, multipath, mounts)
+                if mount and detail:
+                    print(",".join((ai['name'], si['name'], vol['name'])),
+                          ":", mount, ":", path, ":", device)
+                elif mount:
+                    print(",".join((ai['name'], si['name'], vol['name'])),
+                          ":", mount)
+
+
+def _find_mount(ai, si, lun, multipath, mounts=None):
+    ip = si['access']['ips'][0]
+    iqn = si['access']['iqn']
     path = DEV_TEMPLATE.format(ip=ip, iqn=iqn, lun=lun)
     if multipath:
         path = _get_multipath_disk(path)
-    out = exe("ls -l {} | awk '{{print $NF}}'".format(path))
-    device = out.split("/")[-1].strip()
+    device = resolve_device(path) if path else None
     if not device:
         return None, path, device
-    mount = exe("cat /proc/mounts | grep {} | awk '{{print $2}}'".format(
-        device))
-    return mount.strip(), path, device
+    if mounts is None:
+        mounts = read_mounts()
+    return mounts.get(device, ''), path, device
@@ -0,0 +1,174 @@
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import logging
+import threading
+
+from concurrent import futures
+
+from dbmp.utils import AUTO, AimdLimiter, monotonic
+
+
+class Stage(object):
+
+    """
+    A single step in a Pipeline.
+
+    `func` is called with one item and must return a list of items to hand to
+    the next stage.  Returning more than one item fans out, returning an empty
+    list drops the item.  `workers` limits how many items this stage works on
+    at once, AUTO lets an AimdLimiter choose.  Once `failed` is set, items
+    are dropped without calling `func`.
+    """
+
+    def __init__(self, name, func, workers=5):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.limiter = AimdLimiter() if workers == AUTO else None
+        self.timings = []
+        self.pool = None
+        self.failed = None
+
+    def start(self, failed=None):
+        self.failed = failed
+        if self.limiter:
+            size = self.limiter.maximum
+        else:
+            size = max(1, self.workers)
+        self.pool = futures.ThreadPoolExecutor(max_workers=size)
+
+    def _failed(self):
+        return self.failed is not None and self.failed.is_set()
+
+    def run(self, item):
+        if self._failed():
+            return []
+        if self.limiter:
+            self.limiter.acquire()
+            # The pipeline may have failed while we waited for a slot
+            if self._failed():
+                self.limiter.release(None)
+                return []
+        start = monotonic()
+        error = True
+        try:
+            result = self.func(item)
+            error = False
+            return result
+        finally:
+            elapsed = monotonic() - start
+            self.timings.append(elapsed)
+            if self.limiter:
+                self.limiter.release(elapsed, error=error)
+
+
+class Pipeline(object):
+
+    """
+    Moves items through a list of Stages without a barrier between them.
+
+    As soon as a stage finishes with an item, that item is submitted to the
+    next stage, so the first item can reach the last stage while the rest are
+    still in earlier ones.  If any stage raises, work that hasn't started is
+    cancelled, no new work is scheduled and the first exception is re-raised
+    once in-flight work drains.
+    """
+
+    def __init__(self, stages):
+        self.logger = logging.getLogger(__name__)
+        if not self.logger.handlers:
+            self.logger.addHandler(logging.NullHandler())
+        self.stages = stages
+        self.results = []
+        self.first_result = None
+        self.elapsed = None
+        self._pending = 0
+        self._error = None
+        self._failed = threading.Event()
+        self._futures = set()
+        self._start = None
+        self._cond = threading.Condition()
+
+    def _submit(self, index, item):
+        with self._cond:
+            if self._error is not None:
+                return
+            self._pending += 1
+        stage = self.stages[index]
+        f = stage.pool.submit(stage.run, item)
+        with self._cond:
+            self._futures.add(f)
+        f.add_done_callback(
+            lambda fut: self._done(index, fut))
+
+    def _fail(self, e):
+        with self._cond:
+            if self._error is not None:
+                return
+            self._error = e
+            self._failed.set()
+            queued = list(self._futures)
+        # Cancelled futures run their _done callback right away, which
+        # takes care of their pending count
+        for f in queued:
+            f.cancel()
+
+    def _done(self, index, fut):
+        with self._cond:
+            self._futures.discard(fut)
+        items = []
+        if not fut.cancelled():
+            try:
+                items = fut.result()
+            except Exception as e:
+                self.logger.exception("Exception occurred in stage {}".format(
+                    self.stages[index].name))
+                self._fail(e)
+        if index + 1 < len(self.stages):
+            for item in items:
+                self._submit(index + 1, item)
+        elif items:
+            with self._cond:
+                if self.first_result is None:
+                    self.first_result = monotonic() - self._start
+                self.results.extend(items)
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify_all()
+
+    def run(self, items):
+        """
+        Feeds `items` into the first stage and blocks until every item has
+        left the pipeline.  Returns the items produced by the last stage in
+        the order they completed.
+        """
+        self._start = monotonic()
+        for stage in self.stages:
+            stage.start(self._failed)
+        try:
+            for item in items:
+                self._submit(0, item)
+            with self._cond:
+                while self._pending:
+                    self._cond.wait()
+        finally:
+            for stage in self.stages:
+                stage.pool.shutdown(wait=True)
+            self.elapsed = monotonic() - self._start
+        if self._error is not None:
+            raise self._error
+        return self.results
+
+    def report(self):
+        for stage in self.stages:
+            if not stage.timings:
+                continue
+            print("Stage {}: {} items, average {:.2f}s, max {:.2f}s".format(
+                stage.name, len(stage.timings),
+                sum(stage.timings) / len(stage.timings),
+                max(stage.timings)))
+        if self.first_result is not None:
+            print("First item ready after {:.2f}s, {} ready after "
+                  "{:.2f}s".format(self.first_result, len(self.results),
+                                   self.elapsed))
@@ -0,0 +1,160 @@
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import re
+import threading
+
+from dfs_sdk import exceptions as dat_exceptions
+
+from dbmp.utils import dprint, monotonic
+
+# Names per filtered listing, keeps the filter expression a sane length
+CHUNK_SIZE = 50
+
+
+class ReadinessTracker(object):
+
+    """
+    Waits for storage_instances to become available.
+
+    A single poller thread lists every app_instance that still has a pending
+    storage_instance using one filtered list call per CHUNK_SIZE names and
+    wakes each waiter as soon as its storage_instance is available.  The
+    poll interval starts at `min_interval` and grows towards `max_interval`
+    while nothing becomes ready, so the number of calls depends on how long
+    the storage_instances take rather than on how many there are.
+    """
+
+    def __init__(self, min_interval=0.25, max_interval=4.0, backoff=1.5):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.calls = 0
+        self.ready = 0
+        self._api = None
+        self._pending = {}
+        self._entities = {}
+        self._fresh = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def wait(self, api, si, timeout=10):
+        """
+        Blocks until storage_instance `si` is available.  Raises an
+        EnvironmentError if it's still unavailable after `timeout` seconds
+        """
+        # si.path looks like /app_instances/<ai>/storage_instances/<si>
+        parts = si.path.strip('/').split('/')
+        key = (parts[1], parts[3])
+        deadline = monotonic() + timeout
+        with self._cond:
+            self._api = api
+            self._pending[key] = False
+            self._entities[key] = si
+            self._fresh = True
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify_all()
+            try:
+                while not self._pending[key]:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise EnvironmentError(
+                            "Polling ended before storage_instance {} was "
+                            "still unavailable".format(si.path))
+                    self._cond.wait(remaining)
+            finally:
+                del self._pending[key]
+                del self._entities[key]
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            with self._cond:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+    def _loop(self):
+        interval = self.min_interval
+        while True:
+            with self._cond:
+                waiting = [k for k, ready in self._pending.items()
+                           if not ready]
+                if not waiting:
+                    self._thread = None
+                    return
+                api = self._api
+                self._fresh = False
+            available = set()
+            try:
+                available.update(self._poll_round(api, waiting))
+            except Exception as e:
+                # Waiters time out on their own, the poller has to keep
+                # running for the others
+                dprint("Readiness poll failed:", e)
+            with self._cond:
+                found = [k for k in available
+                         if self._pending.get(k) is False]
+                for key in found:
+                    self._pending[key] = True
+                self.ready += len(found)
+                self._cond.notify_all()
+                interval = self.min_interval if found else min(
+                    interval * self.backoff, self.max_interval)
+                # Storage_instances added since the last poll are picked up
+                # after min_interval instead of waiting out the backoff
+                last = monotonic()
+                while True:
+                    if self._fresh:
+                        interval = self.min_interval
+                    remaining = last + interval - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+    def _poll_round(self, api, waiting):
+        names = sorted({ai for ai, _ in waiting})
+        available = set()
+        for i in range(0, len(names), CHUNK_SIZE):
+            chunk = names[i:i + CHUNK_SIZE]
+            rejected = False
+            try:
+                available.update(self._poll(api, chunk))
+            except dat_exceptions.ApiInvalidRequestError as e:
+                dprint("Filtered listing rejected, reloading "
+                       "storage_instances:", e)
+                rejected = True
+            except dat_exceptions.ApiError as e:
+                dprint("Readiness poll failed:", e)
+            if not rejected:
+                continue
+            try:
+                available.update(self._reload(
+                    [k for k in waiting if k[0] in chunk]))
+            except dat_exceptions.ApiError as e:
+                dprint("Readiness reload failed:", e)
+        return available
+
+    def _poll(self, api, names):
+        filt = 'match(name,^({})$)'.format(
+            '|'.join(re.escape(n) for n in names))
+        with self._cond:
+            self.calls += 1
+        for ai in api.app_instances.list(filter=filt):
+            for si in ai['storage_instances']:
+                if si['op_state'] == 'available':
+                    yield ai['name'], si['name']
+
+    def _reload(self, keys):
+        for key in keys:
+            with self._cond:
+                si = self._entities.get(key)
+                self.calls += 1
+            if si is not None and si.reload().op_state == 'available':
+                yield key
+
+
+SI_READY = ReadinessTracker()
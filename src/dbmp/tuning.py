@@ -0,0 +1,160 @@
+"""
+Block device queue tuning.
+
+A profile maps queue attributes under /sys/block/<dev>/queue to the value
+they should have.  The scheduler is a list of preferences, the first one the
+kernel offers is used (blk-mq kernels offer none/mq-deadline, legacy ones
+noop/deadline).
+"""
+from __future__ import (unicode_literals, print_function, absolute_import,
+                        division)
+
+import io
+import json
+import os
+import threading
+
+import six
+
+from dbmp.devices import read_sysfs, write_sysfs
+from dbmp.utils import dprint
+
+ATTRS = ('scheduler', 'nr_requests', 'read_ahead_kb', 'rq_affinity',
+         'nomerges', 'max_sectors_kb')
+
+# Used when no profile is given, matches what dbmp has always done
+DEFAULT = {'scheduler': ['none', 'noop']}
+
+PROFILES = {
+    'latency': {
+        'scheduler': ['none', 'noop'],
+        'nr_requests': 128,
+        'read_ahead_kb': 0,
+        'rq_affinity': 2,
+        'nomerges': 2,
+        'max_sectors_kb': 128,
+    },
+    'throughput': {
+        'scheduler': ['mq-deadline', 'deadline'],
+        'nr_requests': 1024,
+        'read_ahead_kb': 4096,
+        'rq_affinity': 1,
+        'nomerges': 0,
+        'max_sectors_kb': 1024,
+    },
+}
+
+
+def load_profile(name):
+    """
+    Returns the built-in profile `name` or the profile read from JSON file
+    `name`.  Raises a ValueError if it can't be used
+    """
+    if name in PROFILES:
+        return PROFILES[name]
+    if not os.path.isfile(name):
+        raise ValueError(
+            "Unknown tuning profile: {}.  Choices: {} or a JSON file".format(
+                name, ", ".join(sorted(PROFILES))))
+    with io.open(name) as f:
+        profile = json.load(f)
+    unknown = set(profile) - set(ATTRS)
+    if unknown:
+        raise ValueError("Unknown attributes in tuning profile {}: {}".format(
+            name, ", ".join(sorted(unknown))))
+    if isinstance(profile.get('scheduler'), six.string_types):
+        profile['scheduler'] = [profile['scheduler']]
+    return profile
+
+
+def _schedulers(device, root=None):
+    # Looks like: "noop deadline [cfq]" or "[none] mq-deadline kyber"
+    out = read_sysfs(device, 'queue/scheduler', root)
+    current = None
+    names = []
+    for name in out.split():
+        if name.startswith('['):
+            name = name.strip('[]')
+            current = name
+        names.append(name)
+    return names, current
+
+
+class Tuner(object):
+
+    """
+    Applies a tuning profile to block devices and records, for each device,
+    the value asked for and the value read back for every attribute
+    """
+
+    def __init__(self, profile=None, root=None):
+        self.profile = profile or DEFAULT
+        self.name = None
+        self.root = root
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def tune(self, device):
+        """ Applies the profile to `device` once per run """
+        with self._lock:
+            if device in self.results:
+                return
+            self.results[device] = {}
+        result = {}
+        for attr in ATTRS:
+            if attr not in self.profile:
+                continue
+            try:
+                result[attr] = self._apply(device, attr, self.profile[attr])
+            except (IOError, OSError, EnvironmentError) as e:
+                dprint("Could not set {} for {}: {}".format(attr, device, e))
+                wanted = self.profile[attr]
+                if attr == 'scheduler':
+                    wanted = "/".join(wanted)
+                result[attr] = (wanted, None)
+        with self._lock:
+            self.results[device] = result
+
+    def _apply(self, device, attr, value):
+        if attr == 'scheduler':
+            available, current = _schedulers(device, self.root)
+            wanted = next((s for s in value if s in available), None)
+            if wanted is None:
+                return ("/".join(value), current)
+            if wanted != current:
+                dprint("Setting {} scheduler for device: {}".format(
+                    wanted, device))
+                write_sysfs(device, 'queue/scheduler', wanted, self.root)
+            return (wanted, _schedulers(device, self.root)[1])
+        path = 'queue/{}'.format(attr)
+        if attr == 'max_sectors_kb':
+            value = min(int(value), int(read_sysfs(
+                device, 'queue/max_hw_sectors_kb', self.root)))
+        if read_sysfs(device, path, self.root) != str(value):
+            write_sysfs(device, path, value, self.root)
+        return (str(value), read_sysfs(device, path, self.root))
+
+    def report(self):
+        if not self.name or not self.results:
+            return
+        mismatched = 0
+        for device, result in sorted(self.results.items()):
+            failed = ["{}={} (wanted {})".format(attr, actual, wanted)
+                      for attr, (wanted, actual) in sorted(result.items())
+                      if str(wanted) != str(actual)]
+            if failed:
+                mismatched += 1
+                print("Device {} not fully tuned: {}".format(
+                    device, ", ".join(failed)))
+        print("Applied tuning profile {} to {} devices, {} verified".format(
+            self.name, len(self.results), len(self.results) - mismatched))
+
+
+TUNER = Tuner()
+
+
+def configure(name):
+    """ Sets the profile TUNER applies, None keeps the default """
+    if name:
+        TUNER.profile = load_profile(name)
+        TUNER.name = name
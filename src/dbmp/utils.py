@@ -3,24 +3,22 @@ from __future__ import (unicode_literals, print_function, absolute_import,
 
 import logging
 import json
-# Py2-3 compatibility
-try:
-    import queue
-except ImportError:
-    import Queue as queue
 import os
 import platform
 import random
+import sqlite3
 import string
 import subprocess
-import sys
 import tempfile
 import threading
+import time
 from time import sleep
 
-from six import reraise as raise_
+from concurrent import futures
+
 from six.moves import zip_longest
 import paramiko
+from dfs_sdk import exceptions as dat_exceptions
 from dfs_sdk import scaffold
 
 from dbmp.topology import get_topology
@@ -30,6 +28,14 @@ ASSETS = os.path.join(
         os.path.dirname(
             os.path.dirname(os.path.abspath(__file__))), 'assets')
 LOCKS = {}
+# Pass as max_workers to let FuturesParallel tune its own concurrency
+AUTO = 'auto'
+# Errors caused by an overloaded cluster rather than a bad request.  The SDK
+# raises Api503RetryError for 503s and for 500s sent while the REST server is
+# still initializing
+TRANSIENT_ERRORS = (dat_exceptions.Api503RetryError,
+                    dat_exceptions.ApiUnavailableError,
+                    dat_exceptions.ApiConnectionError)
 
 # Python 2/3 compat
 try:
@@ -37,18 +43,104 @@ try:
 except NameError:
     unicode = str
 
+# Python 2/3 compat
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _set_current_thread_name_from_func_name(func):
+    """ Renames the current thread to reflect the name of func """
+    orig_thread_number = threading.current_thread().name.split('-')[-1]
+    threading.current_thread().name = "Parallel-" + \
+        func.__module__ + '.' + func.__name__ + "-" + orig_thread_number
+
 
-class Parallel(object):
+class AimdLimiter(object):
 
     """
-    A helper class that makes it simpler to run tasks multiple times
-    in parallel.  If you have multiple tasks you want to run in parallel
-    you need to encapsulate them in a single function that accepts a variety
-    of arguments.
+    Limits the number of in-flight tasks using additive-increase,
+    multiplicative-decrease.
+
+    Every `limit` successful tasks raise the limit by one.  An error, or a
+    task that takes longer than `latency_factor` times the best smoothed
+    latency seen so far, halves the limit.  Only one decrease happens per
+    window of `limit` completions so a burst of slow tasks doesn't collapse
+    the limit to the minimum.
+    """
+
+    def __init__(self, start=4, minimum=1, maximum=64, latency_factor=2.0):
+        self.limit = start
+        self.minimum = minimum
+        self.maximum = maximum
+        self.peak = start
+        self.latency_factor = latency_factor
+        self.errors = 0
+        self.in_flight = 0
+        self._ewma = None
+        self._baseline = None
+        self._successes = 0
+        self._cooldown = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, latency, error=False):
+        # latency is None for a slot given back without running a task
+        with self._cond:
+            self.in_flight -= 1
+            if latency is not None:
+                self._update(latency, error)
+            self._cond.notify_all()
+
+    def _update(self, latency, error):
+        if self._cooldown:
+            self._cooldown -= 1
+        if error:
+            self.errors += 1
+            self._decrease()
+            return
+        if self._ewma is None:
+            self._ewma = latency
+        else:
+            self._ewma = 0.8 * self._ewma + 0.2 * latency
+        if self._baseline is None or self._ewma < self._baseline:
+            self._baseline = self._ewma
+        if self._ewma > self._baseline * self.latency_factor:
+            self._decrease()
+            return
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self.peak = max(self.peak, self.limit)
+            self._successes = 0
+
+    def _decrease(self):
+        self._successes = 0
+        if self._cooldown:
+            return
+        self.limit = max(self.minimum, self.limit // 2)
+        self._cooldown = self.limit
+        # Latency is re-learned at the new concurrency level
+        self._baseline = self._ewma
+
+
+class FuturesParallel(object):
+
+    """
+    A helper class that makes it simpler to run tasks in parallel on top of
+    concurrent.futures.
+
+    run_threads returns the return value of each task in the order the tasks
+    were given as soon as the last task finishes.  The wall time of each
+    task, not counting time spent waiting for an AUTO slot, is recorded in
+    `timings` using the same ordering.
     """
 
     def __init__(self, funcs, args_list=None, kwargs_list=None, max_workers=5,
-                 timeout=3600):
+                 timeout=None):
         """
 
         :param funcs: A list of functions to be used by the workers
@@ -56,7 +148,10 @@ class Parallel(object):
                           function in `funcs`
         :param kwargs_list: A list of dictionaries of kwargs accepted
                             by each function in `funcs`
-        :param max_workers: The maximum number of simultaneous threads
+        :param max_workers: The maximum number of simultaneous threads or
+                            AUTO for adaptive concurrency
+        :param timeout: Seconds to wait for all tasks to complete, None
+                        waits for as long as they take
         """
         self.logger = logging.getLogger(__name__)
         if not self.logger.handlers:
@@ -65,100 +160,178 @@ class Parallel(object):
         self.args_list = args_list if args_list else []
         self.kwargs_list = kwargs_list if kwargs_list else []
         self.max_workers = max_workers
-        self.queue = queue.Queue()
-        self.exceptions = queue.Queue()
-        self.threads = []
         self.timeout = timeout
-        self.keep_running = True
-
-    @staticmethod
-    def _set_current_thread_name_from_func_name(func):
-        """ Renames the current thread to reflect the name of func """
-        orig_thread_number = threading.current_thread().name.split('-')[-1]
-        threading.current_thread().name = "Parallel-" + \
-            func.__module__ + '.' + func.__name__ + "-" + orig_thread_number
-
-    def _wrapped(self):
-        threading.current_thread().name = "Parallel-Worker-" + \
-            threading.current_thread().name
-        while self.keep_running:
-            try:
-                func, args, kwargs = self.queue.get(block=False)
-            except queue.Empty:
-                break
-            self.logger.debug(
-                "Running {} with args: {} and kwargs {} with thread {}".format(
-                    func, args, kwargs, threading.current_thread()))
+        self.results = []
+        self.timings = []
+        self.limiter = None
+
+    def _tasks(self):
+        if (len(self.funcs) < len(self.args_list) or
+                len(self.funcs) < len(self.kwargs_list)):
+            raise ValueError(
+                "List of functions passed into FuturesParallel must "
+                "be longer or equal in length to the list of args "
+                "and/or kwargs passed to the object.  {}, {}, {"
+                "}".format(self.funcs, self.args_list, self.kwargs_list))
+        tasks = []
+        for func, args, kwargs in zip_longest(
+                self.funcs, self.args_list, self.kwargs_list, fillvalue={}):
+            # Flag a common (and confusing) user error:
+            if isinstance(args, str) or isinstance(args, unicode):
+                msg = "args_list must be list of lists not list of strings"
+                raise ValueError(msg)
+            tasks.append((func, args, kwargs))
+        return tasks
+
+    def _run(self, index, func, args, kwargs):
+        self.logger.debug(
+            "Running {} with args: {} and kwargs {} with thread {}".format(
+                func, args, kwargs, threading.current_thread()))
+        orig_name = threading.current_thread().name
+        _set_current_thread_name_from_func_name(func)
+        try:
+            if self.limiter:
+                return self._run_limited(index, func, args, kwargs)
+            start = monotonic()
             try:
-                # Rename this thread to reflect the function we're running
-                orig_name = threading.current_thread().name
-                self._set_current_thread_name_from_func_name(func)
-                # Call the function:
-                func(*args, **kwargs)
-                # Reset this thread name to its original (e.g. "Thread-9")
-                threading.current_thread().name = orig_name
-            except Exception:
-                self.keep_running = False
-                self.logger.exception("Exception occurred in thread {}".format(
-                    threading.current_thread()))
-                self.exceptions.put(sys.exc_info())
-
-            self.queue.task_done()
+                return func(*args, **kwargs)
+            finally:
+                self.timings[index] = monotonic() - start
+        except Exception:
+            self.logger.exception("Exception occurred in thread {}".format(
+                threading.current_thread()))
+            raise
+        finally:
+            threading.current_thread().name = orig_name
+
+    def _run_limited(self, index, func, args, kwargs):
+        # The limiter only sets how many tasks run at once.  Tasks aren't
+        # retried here since most of them create things, retries belong at
+        # call sites that are safe to repeat (see retry())
+        self.limiter.acquire()
+        # Time spent waiting for a slot isn't part of the task's wall time
+        start = monotonic()
+        error = True
+        try:
+            result = func(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            elapsed = monotonic() - start
+            self.timings[index] = elapsed
+            self.limiter.release(elapsed, error=error)
 
     def run_threads(self):
         """
-        Call this function to start the worker threads.  They will continue
-        running until all args/kwargs are consumed.  This is a blocking call.
+        Runs every task and returns their results in order.  This is a
+        blocking call.  If any task raises, tasks that have not started yet
+        are cancelled and the first exception is re-raised once the running
+        tasks finish.
         """
+        tasks = self._tasks()
+        self.results = [None] * len(tasks)
+        self.timings = [None] * len(tasks)
+        if not tasks:
+            return self.results
+        if self.max_workers == AUTO:
+            self.limiter = AimdLimiter()
+            workers = self.limiter.maximum
+        else:
+            workers = self.max_workers
+        pool = futures.ThreadPoolExecutor(
+            max_workers=max(1, min(workers, len(tasks))))
+        fs = []
+        timed_out = False
         try:
-            for func, args, kwargs in zip_longest(
-                    self.funcs, self.args_list, self.kwargs_list,
-                    fillvalue={}):
-                # Flag a common (and confusing) user error:
-                if isinstance(args, str) or isinstance(args, unicode):
-                    msg = "args_list must be list of lists not list of strings"
-                    raise ValueError(msg)
-                self.queue.put((func, args, kwargs))
-
-            for _ in range(self.max_workers):
-                thread = threading.Thread(target=self._wrapped)
-                thread.setDaemon(True)
-                thread.start()
-                self.threads.append(thread)
-
-            if (len(self.funcs) < len(self.args_list) or
-                    len(self.funcs) < len(self.kwargs_list)):
-                raise ValueError(
-                    "List of functions passed into a Parallel object must "
-                    "be longer or equal in length to the list of args "
-                    "and/or kwargs passed to the object.  {}, {}, {"
-                    "}".format(self.funcs, self.args_list, self.kwargs_list))
-
-            while self.queue.unfinished_tasks:
-                # Check if exception has been generated by a thread and raise
-                # if found one is found
-                try:
-                    exc = self.exceptions.get(block=False)
-                    self.keep_running = False
-                    raise_(*exc)
-                except queue.Empty:
-                    pass
-                sleep(0.2)
-
-        # Ensure all threads will exit regardless of the current
-        # state of the main thread
+            for i, (func, args, kwargs) in enumerate(tasks):
+                fs.append(pool.submit(self._run, i, func, args, kwargs))
+            _, not_done = futures.wait(
+                fs, timeout=self.timeout,
+                return_when=futures.FIRST_EXCEPTION)
+            for f in not_done:
+                f.cancel()
+            for f in fs:
+                if f.done() and not f.cancelled() and f.exception():
+                    f.result()
+            if not_done:
+                timed_out = True
+                raise futures.TimeoutError(
+                    "Tasks did not complete within {}s".format(self.timeout))
+            self.results = [f.result() for f in fs]
+            return self.results
         finally:
+            # Let running tasks finish unless they've already outlived the
+            # timeout
+            pool.shutdown(wait=not timed_out)
+            if self.limiter:
+                print("Adaptive concurrency settled at {} workers (peak {}, "
+                      "{} errors)".format(self.limiter.limit,
+                                          self.limiter.peak,
+                                          self.limiter.errors))
+
+
+class Progress(object):
+
+    """ Thread-safe completion counter that prints every `step` ticks """
+
+    def __init__(self, name, total, step=None):
+        self.name = name
+        self.total = total
+        self.step = step or max(1, total // 10)
+        self.done = 0
+        self._lock = threading.Lock()
+
+    def tick(self):
+        with self._lock:
+            self.done += 1
+            if self.done % self.step == 0 or self.done == self.total:
+                print("{}: {}/{}".format(self.name, self.done, self.total))
+
+
+def retry(func, args=(), kwargs=None, retries=3, delay=1,
+          exceptions=TRANSIENT_ERRORS):
+    """ Calls func, retrying with a linear backoff when it raises one of
+    `exceptions` """
+    kwargs = kwargs or {}
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except exceptions as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            dprint("Retrying {} after error: {}".format(func.__name__, e))
+            sleep(delay * attempt)
 
-            try:
-                exc = self.exceptions.get(block=False)
-                self.keep_running = False
-                # Join all threads to ensure we don't continue
-                # without all threads stopping
-                for thread in self.threads:
-                    thread.join(self.timeout)
-                raise_(*exc)
-            except queue.Empty:
-                pass
+
+class SqliteStore(object):
+
+    """
+    Base for dbmp's sqlite backed files.  Each thread gets its own connection
+    and the schema is created by `_setup` the first time any thread connects
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+            with self._init_lock:
+                if not self._initialized:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    self._setup(conn)
+                    self._initialized = True
+        return conn
+
+    def _setup(self, conn):
+        raise NotImplementedError()
 
 
 def exe(cmd, fail_ok=False):
@@ -7,23 +7,23 @@ import io
 import json
 import os
 import random
+import re
 import socket
 import string
 import sys
 import threading
 
-import six
-
 from dfs_sdk import exceptions as dat_exceptions
 
-from dbmp.utils import Parallel, get_hostname, dprint
+from dbmp.inventory import INV
+from dbmp.keystore import KeyStore
+from dbmp.utils import FuturesParallel, Progress, get_hostname, dprint
+from dbmp.utils import retry
 
 # We only want to set stdout to utf-8 encoding when running interactive mode
 if os.environ.get("DBMP_INTERACTIVE"):
     sys.stdout = codecs.getwriter('utf8')(sys.stdout)
 
-FLOCK = threading.Lock()
-
 STORE_NAME = 'storage-1'
 VOL_NAME = 'volume-1'
 VOL_DEFAULTS = {'size': 1,
@@ -34,7 +34,8 @@ VOL_DEFAULTS = {'size': 1,
                 'template': None,
                 'qos': {},
                 'placement_policy': None,
-                'object': False}
+                'object': False,
+                'nested': True}
 
 MULTI_VOL_TEMPLATE = {'name': 'app-1',
                       'sis': [
@@ -69,7 +70,14 @@ MULTI_VOL_TEMPLATE = {'name': 'app-1',
 
 ACCESS_KEY_CHARS = string.ascii_uppercase + string.digits
 SECRET_KEY_CHARS = string.ascii_letters + string.digits + '/' + '+'
-KEYFILE = ".dbmp-obj-keys"
+KEYS = KeyStore()
+
+# Set the first time the cluster refuses a nested app_instance payload so
+# the remaining creations go straight to the per-resource requests
+NESTED_REJECTED = threading.Event()
+# Matches an API error naming the storage_instances parameter, but not a
+# field inside it
+NESTED_PARAM = re.compile(r'storage_instances(?![\[.\w])')
 
 
 def _is_valid(k):
@@ -91,52 +99,28 @@ def gen_keys():
 
 
 def save_keys(vol_name, ak, sk):
-    with FLOCK:
-        data = {}
-        if os.path.exists(KEYFILE):
-            with io.open(KEYFILE, 'r') as f:
-                data = json.load(f)
-        data[vol_name] = [ak, sk]
-        with io.open(KEYFILE, 'w+') as f:
-            f.write(six.u(json.dumps(data, indent=4)))
+    KEYS.put(vol_name, ak, sk)
+
+
+def _key_names(opts):
+    prefix = opts['prefix']
+    return ['-'.join((prefix, str(i)))
+            for i in reversed(range(opts['count']))]
 
 
 def get_keys(vopt):
-    with FLOCK:
-        opts = parse_vol_opt(vopt)
-        keys = []
-        prefix = opts['prefix']
-        count = opts['count'] - 1
-        if os.path.exists(KEYFILE):
-            with io.open(KEYFILE, 'r') as f:
-                data = json.load(f)
-                while count > -1:
-                    n = '-'.join((prefix, str(count)))
-                    keys.append((n, data.get(n, (None, None))))
-                    count -= 1
-        return keys
+    opts = parse_vol_opt(vopt)
+    if not KEYS.exists():
+        return []
+    return [(n, KEYS.get(n)) for n in _key_names(opts)]
 
 
 def del_keys(vopt):
-    with FLOCK:
-        opts = parse_vol_opt(vopt)
-        if not opts['object']:
-            return
-        prefix = opts['prefix']
-        count = opts['count'] - 1
-        data = {}
-        if os.path.exists(KEYFILE):
-            with io.open(KEYFILE, 'r') as f:
-                try:
-                    data = json.load(f)
-                except ValueError:
-                    pass
-                while count > -1:
-                    n = '-'.join((prefix, str(count)))
-                    data.pop(n, None)
-                    count -= 1
-        with io.open(KEYFILE, 'w+') as f:
-            f.write(six.u(json.dumps(data, indent=4)))
+    opts = parse_vol_opt(vopt)
+    if not opts['object']:
+        return
+    if KEYS.exists():
+        KEYS.delete(_key_names(opts))
 
 
 def read_vol_opts(ifile):
@@ -158,7 +142,7 @@ def parse_vol_opt(s):
         k, v = p.split('=')
         if not _is_valid(k):
             raise EnvironmentError("Volume key: {} is not valid".format(k))
-        if k == 'object':
+        if k in ('object', 'nested'):
             opts[k] = v in ("True", "true")
         elif 'max' in k:
             opts['qos'][k] = int(v)
@@ -170,7 +154,12 @@ def parse_vol_opt(s):
     return opts
 
 
-def ais_from_vols(api, vols):
+def ais_from_vols(api, vols, cached=False):
+    """
+    Returns the app_instances matching a --volume argument.  Read-only callers
+    can pass cached=True to accept inventory data within the configured
+    staleness bound instead of SDK entities
+    """
     ais = []
     try:
         opts = parse_vol_opt(vols)
@@ -188,24 +177,45 @@ def ais_from_vols(api, vols):
             print("No app_instance found matching name: {}".format(
                 opts['name']))
         return ais
-    ais = api.app_instances.list(filter='match(name,{}.*)'.format(
-        opts['prefix']))
+    filt = 'match(name,{}.*)'.format(opts['prefix'])
+    if cached:
+        ais = INV.listing(filt, lambda: api.app_instances.list(filter=filt))
+    else:
+        ais = api.app_instances.list(filter=filt)
     if not ais:
         print("No app_instance found matching prefix: {}".format(
             opts['prefix']))
     return ais
 
 
+def ai_sis(ai):
+    """
+    Returns the storage_instances of an app_instance, each including its
+    volumes.  The app_instance listing already embeds them, so this only falls
+    back to per-app_instance requests if they're missing
+    """
+    sis = ai['storage_instances'] if 'storage_instances' in ai else None
+    if sis and all(isinstance(si, dict) and 'volumes' in si for si in sis):
+        return sis
+    sis = []
+    for si in ai.storage_instances.list(tenant=ai['tenant']):
+        sid = dict(si)
+        sid['volumes'] = [dict(vol) for vol in si.volumes.list(
+            tenant=ai['tenant'])]
+        sis.append(sid)
+    return sis
+
+
 def _print_vol_tree(ai, detail, snodes, metadata):
     if detail:
-        print(ai.name, ai.admin_state)
+        print(ai['name'], ai['admin_state'])
     else:
-        print(ai.name)
+        print(ai['name'])
     if detail:
-        sis = ai.storage_instances.list(tenant=ai['tenant'])
+        sis = ai_sis(ai)
         for i, si in enumerate(sis):
             asns = map(lambda x: x['path'].split('/')[-1],
-                       si.active_storage_nodes)
+                       si['active_storage_nodes'])
             asns = map(lambda x: snodes[x], asns)
             if i < len(sis) - 1:
                 add = '|'
@@ -213,12 +223,12 @@ def _print_vol_tree(ai, detail, snodes, metadata):
                 add = ' '
             print('    |')
             print('    \ {} {} {} {}'.format(
-                si.name, si.access.get('iqn'),
-                json.dumps(si.access.get('ips', [])),
+                si['name'], si['access'].get('iqn'),
+                json.dumps(si['access'].get('ips', [])),
                 json.dumps(list(asns))))
-            for vol in si.volumes.list(tenant=ai['tenant']):
+            for vol in si['volumes']:
                 vasns = map(lambda x: x['path'].split('/')[-1],
-                            vol.active_storage_nodes)
+                            vol['active_storage_nodes'])
                 vasns = map(lambda x: snodes[x], vasns)
                 print('    {}    |'.format(add))
                 if 'placement_policy' in vol:
@@ -226,15 +236,15 @@ def _print_vol_tree(ai, detail, snodes, metadata):
                 else:
                     pp = vol['placement_mode']
                 print('    {}    \ {} {}GB {}-replica {} {}'.format(
-                    add, vol.name, vol.size, vol.replica_count, pp,
+                    add, vol['name'], vol['size'], vol['replica_count'], pp,
                     json.dumps(list(vasns))))
-                if metadata.get(ai.name):
+                if metadata.get(ai['name']):
                     gap = '             '
                     print('{}|'.format(gap))
                     print('{}\ metadata'.format(gap))
                     print('{}  --------'.format(gap))
                     md = ["{}  {}: {}".format(gap, k, v)
-                          for k, v in metadata[ai.name].items()]
+                          for k, v in metadata[ai['name']].items()]
                     print("\n".join(md))
 
 
@@ -259,7 +269,43 @@ def _print_tmpl_tree(tmpl, detail):
                     add, vt.name, vt.size, vt.replica_count, pp))
 
 
-def list_volumes(host, api, vopt, detail):
+def iter_pages(endpoint, page_size, **params):
+    """
+    Yields every entity of a list endpoint, requesting `page_size` entities
+    at a time so only one page is held in memory
+    """
+    offset = 0
+    while True:
+        page = endpoint.list(offset=offset, limit=page_size, **params)
+        for entity in page:
+            yield entity
+        if len(page) < page_size:
+            return
+        offset += page_size
+
+
+def list_ais(api, opts, hostname, page_size=None):
+    """
+    Lists the app_instances matching parsed volume options, leaving the
+    name/prefix filtering to the API.  If page_size is given the result is a
+    generator that fetches one page at a time
+    """
+    if 'sis' in opts:
+        try:
+            return [api.app_instances.get(opts['name'])]
+        except dat_exceptions.ApiNotFoundError:
+            return []
+    params = {}
+    prefix = opts.get('prefix', hostname)
+    if prefix != 'all':
+        params['filter'] = 'match(name,{}.*)'.format(prefix)
+    if page_size:
+        return iter_pages(api.app_instances, page_size, **params)
+    return INV.listing(params.get('filter', 'all'),
+                       lambda: api.app_instances.list(**params))
+
+
+def list_volumes(host, api, vopt, detail, page_size=None):
     opts = parse_vol_opt(vopt)
     hostname = get_hostname(host)
     snodes = {}
@@ -271,12 +317,13 @@ def list_volumes(host, api, vopt, detail):
             metadata = {md.name: md.data for md in mds}
         except (dat_exceptions.ApiError, dat_exceptions.SdkEndpointNotFound):
             pass
-    for ai in sorted(api.app_instances.list(), key=lambda x: x.name):
-        if (opts.get('prefix') == 'all' or
-                opts.get('name') == ai.name or
-                ai.name.startswith(opts.get('prefix', hostname))):
-            print('-------')
-            _print_vol_tree(ai, detail, snodes, metadata)
+    ais = list_ais(api, opts, hostname, page_size)
+    # Streamed listings are printed in the order the API returns them
+    if not page_size:
+        ais = sorted(ais, key=lambda x: x['name'])
+    for ai in ais:
+        print('-------')
+        _print_vol_tree(ai, detail, snodes, metadata)
     print('-------')
 
 
@@ -287,96 +334,233 @@ def list_templates(api, detail):
     print('--------')
 
 
-def _create_volume(hostname, api, opts, i, results):
+def _vol_payload(name, opts, placement_policy=None):
+    vol = {'name': name,
+           'replica_count': opts['replica'],
+           'size': opts['size']}
+    if placement_policy:
+        vol['placement_policy'] = {
+            'path': '/placement_policies/{}'.format(placement_policy)}
+    else:
+        vol['placement_mode'] = opts['placement_mode']
+    if opts['qos']:
+        vol['performance_policy'] = opts['qos']
+    return vol
+
+
+def _create_nested(api, payload):
+    """
+    Creates an app_instance with its storage_instances, volumes and QoS in a
+    single request.  Returns None if the cluster does not accept nested
+    payloads so the caller can fall back to per-resource creation
+    """
+    if NESTED_REJECTED.is_set():
+        return None
+    try:
+        return api.app_instances.create(**payload)
+    except dat_exceptions.ApiInvalidRequestError as e:
+        # Anything else wrong with the payload (placement policy, size, ...)
+        # would fail per-resource creation as well
+        if not _nested_rejected(e):
+            raise
+        dprint("Nested app_instance creation rejected, falling back to "
+               "per-resource creation:", e)
+        NESTED_REJECTED.set()
+        return None
+
+
+def _nested_rejected(e):
+    """
+    True if the API refused the storage_instances parameter itself rather
+    than a value somewhere inside it (eg: storage_instances[0].volumes...)
+    """
+    text = " ".join(str(m) for m in (e, getattr(e, 'message', None)) if m)
+    return bool(NESTED_PARAM.search(text))
+
+
+def _create_volume(hostname, api, opts, i):
     name = opts.get('prefix', hostname) + '-' + str(i)
     sc = "object" if opts['object'] else 'iscsi'
     ak, sk = None, None
+    ncalls = 0
     if opts['template']:
         at = {'path': '/app_templates/{}'.format(opts['template'])}
         ai = api.app_instances.create(name=name, app_template=at)
+        ncalls += 1
     else:
-        ai = api.app_instances.create(name=name)
-        si = ai.storage_instances.create(
-            name=STORE_NAME,
-            service_configuration=sc)
+        ai = None
         pp = opts.get('placement_policy')
-        if not pp:
-            vol = si.volumes.create(
-                name=VOL_NAME,
-                replica_count=opts['replica'],
-                size=opts['size'],
-                placement_mode=opts['placement_mode'])
-        else:
-            vol = si.volumes.create(
-                name=VOL_NAME,
-                replica_count=opts['replica'],
-                size=opts['size'],
-                placement_policy={'path': '/placement_policies/{}'.format(
-                    opts['placement_policy'])})
-        qos = opts['qos']
-        if qos:
-            vol.performance_policy.create(**qos)
         if opts['object']:
             ak, sk = gen_keys()
-            si.auth.set(type="access_keys", access_key=ak, secret_key=sk)
+        if opts['nested'] and not NESTED_REJECTED.is_set():
+            si = {'name': STORE_NAME,
+                  'service_configuration': sc,
+                  'volumes': [_vol_payload(VOL_NAME, opts, pp)]}
+            if opts['object']:
+                si['auth'] = {'type': 'access_keys',
+                              'access_key': ak,
+                              'secret_key': sk}
+            ncalls += 1
+            ai = _create_nested(
+                api, {'name': name, 'storage_instances': [si]})
+        if ai is None:
+            ai = api.app_instances.create(name=name)
+            si = ai.storage_instances.create(
+                name=STORE_NAME,
+                service_configuration=sc)
+            ncalls += 2
+            vp = _vol_payload(VOL_NAME, opts, pp)
+            qos = vp.pop('performance_policy', None)
+            vol = si.volumes.create(**vp)
+            ncalls += 1
+            if qos:
+                vol.performance_policy.create(**qos)
+                ncalls += 1
+            if opts['object']:
+                si.auth.set(type="access_keys", access_key=ak, secret_key=sk)
+                ncalls += 1
+        if opts['object']:
             save_keys(name, ak, sk)
     if ak and sk:
         print("Created Object Store:", name)
         print("Access Credentials:", ak, sk)
     else:
         print("Created volume:", name)
-    results.append(ai)
+    dprint("API calls used creating {}: {}".format(name, ncalls))
+    INV.update(ai)
+    return ai, ncalls
 
 
 def _create_complex_volume(api, opts):
-    ai = api.app_instances.create(name=opts['name'])
+    sis = []
     for dsi in opts['sis']:
-        si = ai.storage_instances.create(name=dsi['name'])
+        vols = []
         for dvol in dsi['vols']:
             tvol = copy.deepcopy(VOL_DEFAULTS)
             tvol.update(**dvol)
-            vol = si.volumes.create(
-                name=tvol['name'],
-                replica_count=tvol['replica'],
-                size=tvol['size'],
-                placement_mode=tvol['placement_mode'])
-            if tvol['qos']:
-                vol.performance_policy.create(**tvol['qos'])
+            vols.append(_vol_payload(tvol['name'], tvol))
+        sis.append({'name': dsi['name'], 'volumes': vols})
+    ai = None
+    if opts['nested']:
+        ai = _create_nested(
+            api, {'name': opts['name'], 'storage_instances': sis})
+    if ai is None:
+        ai = api.app_instances.create(name=opts['name'])
+        for dsi in sis:
+            si = ai.storage_instances.create(name=dsi['name'])
+            for vp in dsi['volumes']:
+                qos = vp.pop('performance_policy', None)
+                vol = si.volumes.create(**vp)
+                if qos:
+                    vol.performance_policy.create(**qos)
     print("Created complex volume:", opts['name'])
+    INV.update(ai)
     return ai
 
 
-def create_volumes(host, api, vopt, workers):
+def reconcile_volumes(opts, ais):
+    """
+    Splits the volumes requested by opts into the app_instances that already
+    exist and the indexes that still need to be created
+    """
+    found = {ai['name']: ai for ai in ais}
+    existing, missing = {}, []
+    for i in range(int(opts['count'])):
+        name = '-'.join((opts['prefix'], str(i)))
+        if name in found:
+            existing[i] = found[name]
+        else:
+            missing.append(i)
+    return existing, missing
+
+
+def create_volumes(host, api, vopt, workers, reconcile=False):
     hostname = get_hostname(host)
     dprint("Creating volumes:", vopt)
     opts = parse_vol_opt(vopt)
     ais = ais_from_vols(api, vopt)
-    # If they already exist lets just use them
-    if ais:
-        return ais
     if 'sis' in opts:
+        if ais:
+            return ais
         return [_create_complex_volume(api, opts)]
-    funcs, args, results = [], [], []
-    for i in range(int(opts['count'])):
+    existing, missing = {}, list(range(int(opts['count'])))
+    if ais and reconcile:
+        existing, missing = reconcile_volumes(opts, ais)
+        print("Found {} existing volumes, creating {} missing".format(
+            len(existing), len(missing)))
+    elif ais:
+        # If they already exist lets just use them
+        return ais
+    funcs, args = [], []
+    for i in missing:
         funcs.append(_create_volume)
-        args.append((hostname, api, opts, i, results))
-    p = Parallel(funcs, args_list=args, max_workers=workers)
-    p.run_threads()
-    return results
+        args.append((hostname, api, opts, i))
+    p = FuturesParallel(funcs, args_list=args, max_workers=workers)
+    created = p.run_threads()
+    if created:
+        total = sum(ncalls for _, ncalls in created)
+        print("Created {} volumes using {} API calls ({:.1f} per "
+              "volume)".format(len(created), total, total / len(created)))
+        dprint("Slowest volume creation took {:.2f}s".format(
+            max(p.timings)))
+    for i, (ai, _) in zip(missing, created):
+        existing[i] = ai
+    return [existing[i] for i in sorted(existing)]
+
+
+def _offline_volume(ai):
+    dprint("Offlining volume:", ai.name)
+    retry(ai.set, kwargs={'admin_state': 'offline', 'force': True})
+
+
+def _delete_volume(ai):
+    dprint("Deleting volume:", ai.name)
+    try:
+        retry(ai.delete, kwargs={'force': True})
+    except dat_exceptions.ApiNotFoundError:
+        dprint("Volume already deleted:", ai.name)
+    INV.remove(ai.name)
 
 
-def _clean_volume(ai):
-    dprint("Cleaning volume:", ai.name)
-    ai.set(admin_state='offline', force=True)
-    ai.delete(force=True)
+def _teardown_phase(name, func, ais, workers):
+    """
+    Runs func against every app_instance concurrently.  Failures don't stop
+    the phase, they're collected and returned alongside the app_instances
+    func succeeded for
+    """
+    progress = Progress(name, len(ais))
+
+    def _task(ai):
+        try:
+            func(ai)
+        except Exception as e:
+            return e
+        finally:
+            progress.tick()
+
+    p = FuturesParallel([_task] * len(ais),
+                        args_list=[(ai,) for ai in ais],
+                        max_workers=workers)
+    errors = p.run_threads()
+    done = [ai for ai, e in zip(ais, errors) if e is None]
+    failed = {ai.name: e for ai, e in zip(ais, errors) if e is not None}
+    return done, failed
 
 
 def clean_volumes(api, vopt, workers):
+    """
+    Offlines every matching app_instance, then deletes the ones that went
+    offline.  Returns a dict of app_instance name to the error that stopped
+    it from being cleaned
+    """
     print("Cleaning volumes matching:", vopt)
     ais = ais_from_vols(api, vopt)
-    funcs, args = [], []
-    for ai in ais:
-        funcs.append(_clean_volume)
-        args.append((ai,))
-    p = Parallel(funcs, args_list=args, max_workers=workers)
-    p.run_threads()
+    offline, failed = _teardown_phase('Offlined', _offline_volume, ais,
+                                      workers)
+    deleted, del_failed = _teardown_phase('Deleted', _delete_volume, offline,
+                                          workers)
+    failed.update(del_failed)
+    print("Cleaned {}/{} volumes".format(len(deleted), len(ais)))
+    for name, e in sorted(failed.items()):
+        print("Failed to clean {}: {}".format(name, e))
+    return failed
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, division
+
+import array
+
+import pytest
+
+from dbmp.metrics import Series
+
+tracemalloc = pytest.importorskip('tracemalloc')
+
+POINTS = 20000
+
+
+def _peak(func):
+    tracemalloc.start()
+    try:
+        kept = func()
+        return kept, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _series():
+    series = Series(array.array(str('d')))
+    for i in range(POINTS):
+        series.append(i, {'time': 1500000000000 + i * 1000, 'value': i})
+    return series
+
+
+def _dicts():
+    return [{'time': 1500000000000 + i * 1000, 'value': i, 'tick': i,
+             'local_time': 1500000000.0 + i}
+            for i in range(POINTS)]
+
+
+def test_series_nbytes_counts_its_columns():
+    series = _series()
+    # int32 tick, int64 time and int64 value per point
+    assert series.nbytes() == POINTS * (4 + 8 + 8)
+    series.append(POINTS, {'time': 0, 'value': 0.5})
+    assert series.values.typecode == 'd'
+    assert series.nbytes() == (POINTS + 1) * (4 + 8 + 8)
+
+
+def test_series_uses_less_memory_than_point_dicts():
+    series, columns = _peak(_series)
+    _, dicts = _peak(_dicts)
+    # array growth over-allocates, so allow twice the column footprint
+    assert columns < series.nbytes() * 2
+    assert columns * 5 < dicts
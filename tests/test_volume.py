@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, print_function, division
+
+import io
+import os
+import sys
+
+import pytest
+
+from dbmp.volume import iter_pages, list_volumes
+
+tracemalloc = pytest.importorskip('tracemalloc')
+
+PAGE_SIZE = 100
+
+
+class FakeAppInstances(object):
+
+    """
+    Stands in for api.app_instances with `count` app_instances.  Each page
+    is built when it's requested so the fake itself doesn't hold the
+    inventory.  Requests are only recorded if `calls` is a list
+    """
+
+    def __init__(self, count, calls=None):
+        self.count = count
+        self.calls = calls
+
+    def list(self, offset=0, limit=None, **params):
+        if self.calls is not None:
+            self.calls.append((offset, limit, params))
+        end = self.count if limit is None else min(offset + limit,
+                                                   self.count)
+        return [{'name': 'vol-{}'.format(i),
+                 'admin_state': 'online',
+                 'storage_instances': []}
+                for i in range(offset, end)]
+
+
+class FakeApi(object):
+
+    def __init__(self, count):
+        self.app_instances = FakeAppInstances(count)
+
+
+def _peak(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.fixture
+def devnull(monkeypatch):
+    with io.open(os.devnull, 'w') as f:
+        monkeypatch.setattr(sys, 'stdout', f)
+        yield
+
+
+def test_iter_pages_requests_every_page():
+    calls = []
+    ep = FakeAppInstances(250, calls)
+    names = [ai['name'] for ai in iter_pages(ep, PAGE_SIZE, filter='x')]
+    assert names == ['vol-{}'.format(i) for i in range(250)]
+    assert calls == [(0, PAGE_SIZE, {'filter': 'x'}),
+                     (100, PAGE_SIZE, {'filter': 'x'}),
+                     (200, PAGE_SIZE, {'filter': 'x'})]
+
+
+def test_iter_pages_memory_does_not_grow_with_inventory():
+    def _drain(count):
+        for _ in iter_pages(FakeAppInstances(count), PAGE_SIZE):
+            pass
+
+    small = _peak(lambda: _drain(5000))
+    large = _peak(lambda: _drain(50000))
+    assert large < small * 2
+
+
+def test_list_volumes_memory_does_not_grow_with_inventory(devnull):
+    def _list(count):
+        list_volumes('local', FakeApi(count), 'prefix=all', False,
+                     page_size=PAGE_SIZE)
+
+    small = _peak(lambda: _list(5000))
+    large = _peak(lambda: _list(50000))
+    assert large < small * 2